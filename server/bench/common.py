@@ -0,0 +1,69 @@
+#coding: utf-8
+
+""" Synthetic app and tables shared by the benchmarks """
+
+import random
+from datetime import datetime, timedelta
+
+from flask import Blueprint
+
+from gvars import db
+from utils.app import MyFlask, BaseMethodView
+from utils.model import BaseModel
+
+
+class BenchItem(BaseModel):
+    __tablename__ = 'bench_item'
+
+    name = db.Column(db.String(64), nullable=False)
+    category = db.Column(db.Integer, nullable=False, index=True)
+    price = db.Column(db.Numeric(10, 2))
+    note = db.Column(db.Text)
+
+
+bp = Blueprint('bench', __name__)
+
+
+class BenchItemView(BaseMethodView):
+    blueprint = bp
+    endpoint = 'items'
+    Model = BenchItem
+    url_rules = [
+        (['/bench/items/'], {'defaults': {'oid': None}}),
+        (['/bench/items/<int:oid>'], {}),
+    ]
+
+
+def create_app(database_uri='sqlite://', **config):
+    app = MyFlask('bench')
+    app.config.update(SQLALCHEMY_DATABASE_URI=database_uri, DEFAULT_PERPAGE=20)
+    app.config.update(config)
+    db.init_app(app)
+    if not bp.deferred_functions:
+        BenchItemView.register_urls()
+    app.register_blueprint(bp)
+    return app
+
+
+def populate(app, rows, seed=0):
+    """ (Re)create the bench tables with `rows` records """
+    rnd = random.Random(seed)
+    start = datetime(2016, 1, 1)
+    with app.app_context():
+        BenchItem.__table__.drop(db.engine, checkfirst=True)
+        BenchItem.__table__.create(db.engine)
+        batch = []
+        for i in xrange(rows):
+            batch.append({
+                'name': u'item-{}'.format(i),
+                'category': rnd.randint(1, 20),
+                'price': rnd.randint(100, 100000) / 100.0,
+                'note': u'n' * rnd.randint(10, 300),
+                'created_at': start + timedelta(minutes=i),
+            })
+            if len(batch) >= 1000:
+                db.session.execute(BenchItem.__table__.insert(), batch)
+                batch = []
+        if batch:
+            db.session.execute(BenchItem.__table__.insert(), batch)
+        db.session.commit()
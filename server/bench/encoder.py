@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#coding: utf-8
+
+"""
+Microbenchmark of the JSON response path of `MyFlask.make_response`.
+
+    cd server && python -m bench.encoder --rows 500 --repeat 50
+
+  before : json.dumps + the two eager debug log formats (DEBUG off)
+  after  : the `utils.encoder` backends, log formatting skipped
+"""
+
+import json
+import timeit
+import argparse
+from datetime import datetime
+
+from utils.encoder import BACKENDS, get_dumps
+
+
+def make_rv(rows):
+    now = datetime.now()
+    objects = []
+    for i in xrange(rows):
+        objects.append({
+            'id': i,
+            'name': u'名字-{}'.format(i),
+            'price': 12.5 + i,
+            'note': u'x' * 200,
+            'enabled': i % 2 == 0,
+            'created_at': 1450000000 + i,
+            'created_at_str': now.strftime('%Y-%m-%d %H:%M:%S'),
+            'updated_at': None,
+        })
+    return {'total': rows * 10, 'objects': objects}
+
+
+def before(rv):
+    u'Response(original): rv={}, status={}, headers={}'.format(rv, None, None)
+    body = json.dumps(rv)
+    u'Response(final): rv={}, status={}, headers={}'.format(body, None, None)
+    return body
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    rv = make_rv(args.rows)
+    cases = [('before', before)]
+    for name in sorted(BACKENDS):
+        if BACKENDS[name]() is not None:
+            cases.append(('after:{}'.format(name), get_dumps(name)))
+
+    base = None
+    print '{:<20} {:>12} {:>10}'.format('case', 'ms/response', 'speedup')
+    for name, func in cases:
+        seconds = min(timeit.repeat(lambda: func(rv), number=args.repeat, repeat=3))
+        ms = seconds / args.repeat * 1000
+        base = base or ms
+        print '{:<20} {:>12.3f} {:>9.2f}x'.format(name, ms, base / ms)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#coding: utf-8
+
+"""
+`utils.ipdb` against the stock `IP.find` on a skewed address stream (a few
+clients send most of the requests, like the API traffic).
+
+    cd server && python -m bench.ip_lookup --lookups 20000 --clients 2000
+"""
+
+import time
+import random
+import socket
+import argparse
+
+import IP
+
+from utils.ipdb import IPLocator
+
+
+def addresses(lookups, clients, seed=0):
+    rnd = random.Random(seed)
+    # Unicast addresses, `IP.find` answers garbage from 224.0.0.0 on
+    pool = ['{}.{}.{}.{}'.format(rnd.randint(1, 223), rnd.randint(0, 255),
+                                 rnd.randint(0, 255), rnd.randint(1, 254))
+            for _ in xrange(clients)]
+    # Pareto: low indexes are the busy clients
+    return [pool[min(int((rnd.paretovariate(1.2) - 1) * 100), clients - 1)]
+            for _ in xrange(lookups)]
+
+
+def timeit(func, ips):
+    start = time.time()
+    func(ips)
+    return (time.time() - start) / len(ips) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--clients', type=int, default=2000)
+    args = parser.parse_args()
+
+    ips = addresses(args.lookups, args.clients)
+    locator = IPLocator(cache_size=0)
+    mismatch = [ip for ip in set(ips) if locator._lookup(socket.inet_aton(ip)) != IP.find(ip)]
+    print 'distinct addresses: {}, mismatches: {}'.format(len(set(ips)), len(mismatch))
+
+    results = [
+        ('IP.find', timeit(lambda ips: [IP.find(ip) for ip in ips], ips)),
+        ('IPLocator.find (no cache)', timeit(lambda ips: [locator.find(ip) for ip in ips], ips)),
+    ]
+    locator = IPLocator(cache_size=10000)
+    results.append(('IPLocator.find (LRU)', timeit(lambda ips: [locator.find(ip) for ip in ips], ips)))
+    locator = IPLocator(cache_size=10000)
+    results.append(('IPLocator.find_many (LRU)', timeit(locator.find_many, ips)))
+    for name, us in results:
+        print '{:<30} {:>8.2f} us/lookup'.format(name, us)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#coding: utf-8
+
+"""
+Python overhead per list request of `QueryProcessor` with and without the
+cached query plans (QUERY_PLAN_CACHE), on a SQLite stand-in.
+
+    cd server && python -m bench.query_plan --rows 1000 --repeat 500
+"""
+
+import json
+import time
+import argparse
+
+from flask import request
+
+from utils.model import QueryProcessor
+from bench.common import BenchItem, create_app, populate
+
+
+SHAPES = [
+    {},
+    {'filters': [['category', '==', 3]], 'sort': [['price', 'desc']]},
+    {'filters': [['category', '>=', 5], ['name', 'ilike', 'item-1']], 'page': 2},
+]
+
+
+def run(app, q, repeat):
+    url = '/?q={}'.format(json.dumps(q))
+    start = time.time()
+    for i in xrange(repeat):
+        with app.test_request_context(url):
+            QueryProcessor.build(request, BenchItem).get_rv()
+    return (time.time() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    app = create_app()
+    populate(app, args.rows)
+    print '{:<70} {:>10} {:>10}'.format('shape', 'before us', 'after us')
+    for q in SHAPES:
+        times = []
+        for cached in (False, True):
+            app.config['QUERY_PLAN_CACHE'] = cached
+            run(app, q, 10)     # Warm up
+            times.append(run(app, q, args.repeat))
+        print '{:<70} {:>10.1f} {:>10.1f}'.format(json.dumps(q)[:70], times[0], times[1])
+
+
+if __name__ == '__main__':
+    main()
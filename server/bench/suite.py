@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+#coding: utf-8
+
+"""
+Load/benchmark suite of the API stack (`QueryProcessor`, `to_dict`,
+`MyFlask.make_response`) on the synthetic `bench_item` table, see
+`manager.py bench`.
+
+Modes:
+  client : the Flask test client, one request at a time (no network)
+  gevent : a gevent WSGI server in a forked process, driven over HTTP with
+           keep-alive connections from `concurrency` threads
+
+Per scenario and mode: req/s and p50/p99 latency (ms). The test client
+runs also report the SQL queries per request and the net GC-tracked objects
+allocated per request (objects that survive or wait for the cycle collector).
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import httplib
+import urllib
+import platform
+import threading
+import subprocess
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from gvars import db
+from bench.common import create_app, populate
+
+
+SCENARIOS = ('list', 'detail', 'filter', 'sort')
+MODES = ('client', 'gevent')
+
+_queries = [0]
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    _queries[0] += 1
+
+
+def scenario_urls(name, rows, n, seed=0):
+    rnd = random.Random(seed)
+    for _ in xrange(n):
+        if name == 'list':
+            q = {'page': rnd.randint(1, 5)}
+        elif name == 'detail':
+            yield '/bench/items/{}'.format(rnd.randint(1, rows))
+            continue
+        elif name == 'filter':
+            q = {'filters': [['category', '==', rnd.randint(1, 20)],
+                             ['price', '>=', rnd.randint(1, 500)]]}
+        elif name == 'sort':
+            q = {'sort': [['price', 'desc'], ['id', 'asc']], 'page': rnd.randint(1, 5)}
+        yield '/bench/items/?' + urllib.urlencode({'q': json.dumps(q)})
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+def summarize(latencies, elapsed, errors):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.5), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+    }
+
+
+def run_client(app, urls):
+    client = app.test_client()
+    for url in urls[:20]:       # Warm up
+        client.get(url)
+    latencies, errors = [], 0
+    queries = _queries[0]
+    gc.collect()
+    gc.disable()
+    objects = gc.get_count()[0]
+    start = time.time()
+    try:
+        for url in urls:
+            t = time.time()
+            response = client.get(url)
+            latencies.append(time.time() - t)
+            if response.status_code != 200:
+                errors += 1
+    finally:
+        elapsed = time.time() - start
+        objects = gc.get_count()[0] - objects
+        gc.enable()
+    rv = summarize(latencies, elapsed, errors)
+    rv['queries_per_request'] = round(float(_queries[0] - queries) / len(urls), 2)
+    rv['gc_objects_per_request'] = round(float(objects) / len(urls), 1)
+    return rv
+
+
+def serve_gevent(app, listener):
+    """ In the forked child: serve until SIGTERM """
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent.socket
+    from gevent.pywsgi import WSGIServer
+
+    with app.app_context():
+        db.get_engine(app).dispose()
+    # The listener was created before the patching, wrap its fd
+    listener = gevent.socket.fromfd(listener.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    server = WSGIServer(listener, app, log=None)
+    signal.signal(signal.SIGTERM, lambda *args: os._exit(0))
+    server.serve_forever()
+
+
+def run_gevent(app, urls, concurrency):
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Inherited by the accepted sockets: without it every keep-alive response
+    # waits ~40ms on Nagle and the client's delayed ACK
+    listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    port = listener.getsockname()[1]
+    pid = os.fork()
+    if pid == 0:
+        try:
+            serve_gevent(app, listener)
+        finally:
+            os._exit(1)
+    listener.close()
+
+    lock = threading.Lock()
+    pending = iter(urls)
+    latencies, errors = [], [0]
+
+    def worker():
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+        while True:
+            with lock:
+                url = next(pending, None)
+            if url is None:
+                break
+            t = time.time()
+            try:
+                conn.request('GET', url)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+                ok = False
+            with lock:
+                latencies.append(time.time() - t)
+                if not ok:
+                    errors[0] += 1
+        conn.close()
+
+    try:
+        _wait_port(port)
+        start = time.time()
+        threads = [threading.Thread(target=worker) for _ in xrange(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    rv = summarize(latencies, elapsed, errors[0])
+    rv['concurrency'] = concurrency
+    return rv
+
+
+def _wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(database=None, rows=10000, requests=1000, concurrency=10,
+        scenarios=SCENARIOS, modes=MODES, **config):
+    """ Run the scenarios, returns the report (a dict, dump it as JSON) """
+    if database is None:
+        database = 'sqlite:///{}'.format(os.path.abspath('tmp/bench.db'))
+        if not os.path.isdir('tmp'):
+            os.makedirs('tmp')
+    config.setdefault('QUERY_COUNT_WARN', sys.maxint)
+    app = create_app(database, **config)
+    populate(app, rows)
+
+    results = []
+    for name in scenarios:
+        urls = list(scenario_urls(name, rows, requests))
+        for mode in modes:
+            if mode == 'gevent':
+                try:
+                    import gevent
+                except ImportError:
+                    results.append({'scenario': name, 'mode': mode, 'error': 'gevent not installed'})
+                    continue
+                rv = run_gevent(app, urls, concurrency)
+            else:
+                rv = run_client(app, urls)
+            rv.update(scenario=name, mode=mode)
+            results.append(rv)
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'database': database.split('://')[0],
+            'rows': rows,
+            'python': platform.python_version(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
@@ -0,0 +1,29 @@
+#coding: utf-8
+
+import redis
+from flask import current_app
+
+
+_redis_clients = {}
+
+def get_redis():
+    """ The redis client of the `CACHE_REDIS_*` config (shared pool per process).
+
+    A stalled redis must not hang the greenlets waiting on it: commands give
+    up after CACHE_REDIS_SOCKET_TIMEOUT seconds, connecting after
+    CACHE_REDIS_CONNECT_TIMEOUT (default: 1 both), with a `redis.TimeoutError`
+    the callers handle like any other redis error.
+    """
+    config = current_app.config
+    key = (config.get('CACHE_REDIS_HOST', '127.0.0.1'),
+           config.get('CACHE_REDIS_PORT', 6379),
+           config.get('CACHE_REDIS_DB', 0),
+           config.get('CACHE_REDIS_SOCKET_TIMEOUT', 1),
+           config.get('CACHE_REDIS_CONNECT_TIMEOUT', 1))
+    client = _redis_clients.get(key)
+    if client is None:
+        host, port, db, timeout, connect_timeout = key
+        client = _redis_clients[key] = redis.StrictRedis(
+            host=host, port=port, db=db, socket_timeout=timeout,
+            socket_connect_timeout=connect_timeout)
+    return client
@@ -0,0 +1,264 @@
+#coding: utf-8
+
+"""
+Read-through cache for detail reads (`BaseMethodView.get_one`) and list
+reads (`QueryProcessor.get_rv`).
+
+  Tier 1: bounded per-worker LRU with a short TTL (API_CACHE_LRU_SIZE, API_CACHE_LRU_TTL)
+  Tier 2: redis of the `CACHE_REDIS_*` config (API_CACHE_TTL)
+
+Models opt in through their Meta class:
+
+    class Meta:
+        cache_detail = True
+        cache_ttl = 300      # Optional, overrides API_CACHE_TTL
+
+Entries are dropped on `after_update`/`after_delete` of the object and once
+more after the session commits. Other workers only see the delete in redis,
+their LRU entry lives until API_CACHE_LRU_TTL, so keep it short.
+
+Cache fills read from the primary (`utils.routing.primary_reads`), a lagging
+replica would keep stale rows in the cache for the whole TTL.
+
+List results are cached under the canonical hash of the normalized query
+and a per-table version counter in redis, which is bumped by every flush
+touching the model (and again after commit):
+
+    class Meta:
+        cache_list = True
+        cache_list_ttl = 30  # Optional, overrides API_CACHE_LIST_TTL
+
+Hit/miss/eviction counts are sent to statsd as `api_cache.list.*`.
+"""
+
+import json
+
+import redis
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from flask import current_app, has_app_context
+
+from gvars import statsd_client
+from cache import get_redis
+from cache.lru import LRUCache
+from utils.model import BaseModel
+from utils.routing import primary_reads
+
+
+_local_cache = None
+_local_list_cache = None
+
+def get_local_cache():
+    global _local_cache
+    if _local_cache is None:
+        config = current_app.config
+        _local_cache = LRUCache(config.get('API_CACHE_LRU_SIZE', 4096),
+                                config.get('API_CACHE_LRU_TTL', 5))
+    return _local_cache
+
+
+def get_local_list_cache():
+    global _local_list_cache
+    if _local_list_cache is None:
+        config = current_app.config
+        _local_list_cache = LRUCache(config.get('API_CACHE_LIST_LRU_SIZE', 256),
+                                     config.get('API_CACHE_LRU_TTL', 5))
+    return _local_list_cache
+
+
+def is_cacheable(Model):
+    return getattr(getattr(Model, 'Meta', None), 'cache_detail', False)
+
+
+def is_list_cacheable(Model):
+    return getattr(getattr(Model, 'Meta', None), 'cache_list', False)
+
+
+def object_key(Model, oid):
+    return 'api:obj:{}:{}'.format(Model.__tablename__, oid)
+
+
+def get_object(Model, oid, loader):
+    """ Get the serialized object from the cache, or `loader()` and cache it """
+    key = object_key(Model, oid)
+    local_cache = get_local_cache()
+    data = local_cache.get(key)
+    if data is not None:
+        return data
+
+    ttl = getattr(Model.Meta, 'cache_ttl', None) or \
+          current_app.config.get('API_CACHE_TTL', 300)
+    try:
+        value = get_redis().get(key)
+    except redis.RedisError:
+        current_app.logger.exception(u'Redis get failed: key={}'.format(key))
+        value = None
+    if value is not None:
+        data = json.loads(value)
+    else:
+        with primary_reads():
+            data = loader()
+        try:
+            get_redis().setex(key, ttl, json.dumps(data))
+        except redis.RedisError:
+            current_app.logger.exception(u'Redis set failed: key={}'.format(key))
+    local_cache.set(key, data)
+    return data
+
+
+def get_objects(Model, oids):
+    """ The cached serialized objects of `oids` as {oid: data}, one MGET for
+    the ones missing in the LRU """
+    found = {}
+    local_cache = get_local_cache()
+    missing = []
+    for oid in oids:
+        data = local_cache.get(object_key(Model, oid))
+        if data is not None:
+            found[oid] = data
+        else:
+            missing.append(oid)
+    if missing:
+        keys = [object_key(Model, oid) for oid in missing]
+        try:
+            values = get_redis().mget(keys)
+        except redis.RedisError:
+            current_app.logger.exception(u'Redis mget failed: keys={}'.format(keys))
+            values = []
+        for oid, key, value in zip(missing, keys, values):
+            if value is not None:
+                found[oid] = data = json.loads(value)
+                local_cache.set(key, data)
+    return found
+
+
+def set_objects(Model, objects):
+    """ Cache serialized objects given as {oid: data} """
+    ttl = getattr(Model.Meta, 'cache_ttl', None) or \
+          current_app.config.get('API_CACHE_TTL', 300)
+    local_cache = get_local_cache()
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for oid, data in objects.iteritems():
+            pipe.setex(object_key(Model, oid), ttl, json.dumps(data))
+        pipe.execute()
+    except redis.RedisError:
+        current_app.logger.exception(u'Redis set objects failed: {}'.format(Model))
+    for oid, data in objects.iteritems():
+        local_cache.set(object_key(Model, oid), data)
+
+
+def invalidate(Model, oid):
+    key = object_key(Model, oid)
+    if _local_cache is not None:
+        _local_cache.delete(key)
+    if has_app_context():
+        try:
+            get_redis().delete(key)
+        except redis.RedisError:
+            current_app.logger.exception(u'Redis delete failed: key={}'.format(key))
+
+
+def version_key(Model):
+    return 'api:ver:{}'.format(Model.__tablename__)
+
+
+def list_key(processor):
+    """ The cache key of the list, None when the table version is not available """
+    Model = processor.model
+    try:
+        version = int(get_redis().get(version_key(Model)) or 0)
+    except redis.RedisError:
+        current_app.logger.exception(u'Redis get version failed: {}'.format(Model))
+        return None
+    return 'api:list:{}:{}:{}'.format(Model.__tablename__, version, processor.query_hash())
+
+
+def get_list(processor):
+    """ `processor.get_rv()` through the cache """
+    Model = processor.model
+    key = list_key(processor)
+    if key is None:
+        return processor.get_rv()
+    local_cache = get_local_list_cache()
+    rv = local_cache.get(key)
+    if rv is None:
+        try:
+            value = get_redis().get(key)
+        except redis.RedisError:
+            current_app.logger.exception(u'Redis get failed: key={}'.format(key))
+            value = None
+        if value is not None:
+            rv = json.loads(value)
+    if rv is not None:
+        statsd_client.incr('api_cache.list.hit')
+        local_cache.set(key, rv)
+        return rv
+
+    statsd_client.incr('api_cache.list.miss')
+    with primary_reads():
+        rv = processor.get_rv()
+    ttl = getattr(Model.Meta, 'cache_list_ttl', None) or \
+          current_app.config.get('API_CACHE_LIST_TTL', 30)
+    try:
+        get_redis().setex(key, ttl, json.dumps(rv))
+    except redis.RedisError:
+        current_app.logger.exception(u'Redis set failed: key={}'.format(key))
+    evictions = local_cache.evictions
+    local_cache.set(key, rv)
+    if local_cache.evictions > evictions:
+        statsd_client.incr('api_cache.list.eviction', local_cache.evictions - evictions)
+    return rv
+
+
+def bump_versions(Models):
+    if not Models or not has_app_context():
+        return
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for Model in Models:
+            pipe.incr(version_key(Model))
+        pipe.execute()
+    except redis.RedisError:
+        current_app.logger.exception(u'Redis incr versions failed: {}'.format(Models))
+
+
+# ==============================================================================
+#  Invalidation
+# ==============================================================================
+
+def _on_change(mapper, connection, target):
+    Model = type(target)
+    if not is_cacheable(Model):
+        return
+    invalidate(Model, target.id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('api_cache_dirty', set()).add((Model, target.id))
+
+
+def _after_flush(session, flush_context):
+    Models = set(type(obj) for obj in
+                 list(session.new) + list(session.dirty) + list(session.deleted))
+    Models = set(Model for Model in Models if is_list_cacheable(Model))
+    bump_versions(Models)
+    session.info.setdefault('api_cache_tables', set()).update(Models)
+
+
+def _after_commit(session):
+    # A reader may have cached the old rows between flush and commit
+    for Model, oid in session.info.pop('api_cache_dirty', ()):
+        invalidate(Model, oid)
+    bump_versions(session.info.pop('api_cache_tables', ()))
+
+
+def _after_rollback(session):
+    session.info.pop('api_cache_dirty', None)
+    session.info.pop('api_cache_tables', None)
+
+
+event.listen(BaseModel, 'after_update', _on_change, propagate=True)
+event.listen(BaseModel, 'after_delete', _on_change, propagate=True)
+event.listen(Session, 'after_flush', _after_flush)
+event.listen(Session, 'after_commit', _after_commit)
+event.listen(Session, 'after_rollback', _after_rollback)
@@ -0,0 +1,52 @@
+#coding: utf-8
+
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ Bounded in-process LRU mapping, entries expire `ttl` seconds after
+    they are set (`ttl=0` means never).
+
+    There is no lock: under gevent nothing in here yields to another greenlet.
+    """
+
+    def __init__(self, maxsize=1024, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires = item
+        if expires and expires < time.time():
+            self.misses += 1
+            return default
+        # Re-insert as the most recently used
+        self._data[key] = item
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._data.pop(key, None)
+        self._data[key] = (value, time.time() + ttl if ttl else 0)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,126 @@
+#coding: utf-8
+
+"""
+Single-flight request coalescing: concurrent identical reads share one
+database round trip and its result.
+
+  SINGLE_FLIGHT       : Coalesce within the worker (default: True)
+  SINGLE_FLIGHT_REDIS : Also coalesce across workers with a redis lock (default: False)
+  SINGLE_FLIGHT_LOCK_TTL    : Seconds the redis lock (and the waiting) lasts (default: 10)
+  SINGLE_FLIGHT_RESULT_TTL  : Seconds the shared result stays in redis (default: 2)
+
+The shared result is returned to every caller, treat it as read-only. Reads
+from a replica are only shared with other replica reads (see `utils.routing`),
+clients kept on the primary never get a lagging replica's result.
+"""
+
+import sys
+import json
+import time
+import uuid
+import threading
+
+import redis
+from flask import current_app
+
+from cache import get_redis
+from utils.routing import is_read_only
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """ Calls of `do` with the same key while one is running wait for it and
+    share its result (or exception), see `utils.background` for the waiting
+    under gevent. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.exc_info:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result
+
+
+def redis_do(key, func):
+    """ Coalesce across workers: the lock holder runs `func` and publishes the
+    result, the others poll for it. When the holder fails (or the wait times
+    out) the waiters run `func` themselves. """
+    config = current_app.config
+    lock_ttl = config.get('SINGLE_FLIGHT_LOCK_TTL', 10)
+    lock_key = 'sf:lock:{}'.format(key)
+    result_key = 'sf:rv:{}'.format(key)
+    token = uuid.uuid4().hex
+    try:
+        client = get_redis()
+        locked = client.set(lock_key, token, nx=True, ex=lock_ttl)
+    except redis.RedisError:
+        current_app.logger.exception(u'Redis lock failed: key={}'.format(lock_key))
+        return func()
+
+    if locked:
+        try:
+            rv = func()
+            try:
+                client.setex(result_key, config.get('SINGLE_FLIGHT_RESULT_TTL', 2), json.dumps(rv))
+            except redis.RedisError:
+                current_app.logger.exception(u'Redis publish failed: key={}'.format(result_key))
+            return rv
+        finally:
+            # Only release our own lock
+            try:
+                if client.get(lock_key) == token:
+                    client.delete(lock_key)
+            except redis.RedisError:
+                current_app.logger.exception(u'Redis unlock failed: key={}'.format(lock_key))
+
+    deadline = time.time() + lock_ttl
+    while time.time() < deadline:
+        try:
+            value, holder = client.mget(result_key, lock_key)
+        except redis.RedisError:
+            current_app.logger.exception(u'Redis poll failed: key={}'.format(result_key))
+            break
+        if value is not None:
+            return json.loads(value)
+        if holder is None:
+            break
+        time.sleep(0.05)
+    return func()
+
+
+_single_flight = SingleFlight()
+
+def do(key, func):
+    config = current_app.config
+    if not config.get('SINGLE_FLIGHT', True):
+        return func()
+    key = '{}:{}'.format(key, 'replica' if is_read_only() else 'primary')
+    if config.get('SINGLE_FLIGHT_REDIS', False):
+        return _single_flight.do(key, lambda: redis_do(key, func))
+    return _single_flight.do(key, func)
@@ -37,6 +37,83 @@ def create_table(name):
     print '>> Table created: {}'.format(Model.__table__)
 
 
+@manager.command
+def create_search_indexes():
+    u""" 创建全文/三元组搜索索引 (Meta.search_columns) """
+    from utils.model import SearchField
+
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction block
+    conn = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        for name, Model in sorted(vars(models).iteritems()):
+            if not isinstance(Model, type) or not hasattr(Model, '__table__') \
+               or not getattr(getattr(Model, 'Meta', None), 'search_columns', None):
+                continue
+            for statement in SearchField.of(Model, '*').index_ddl():
+                print '>> {}'.format(statement)
+                conn.execute(statement)
+    finally:
+        conn.close()
+    print '>>> Search indexes created!'
+
+
+@manager.option('-d', '--directory', dest='directory', default=None)
+@manager.option('-n', '--top', dest='top', default=10)
+def profiles(directory=None, top=10):
+    u""" 汇总采样的请求 profile (按 endpoint) """
+    from collections import defaultdict
+    from utils.profiler import load_profiles
+
+    directory = directory or app.config.get('PROFILE_DIR', 'tmp/profiles')
+    top = int(top)
+    for (endpoint, method), profile in sorted(load_profiles(directory).iteritems()):
+        durations = sorted(profile['durations'])
+        print '=' * 60
+        print '[{} {}] samples={}, p50={}ms, max={}ms'.format(
+            method, endpoint, len(durations), durations[len(durations) // 2], durations[-1])
+        # Self samples (leaf frame) and total samples (anywhere in the stack)
+        leaf = defaultdict(int)
+        total = defaultdict(int)
+        for stack, count in profile['stacks'].iteritems():
+            frames = stack.split(';')
+            leaf[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        count_all = sum(profile['stacks'].values()) or 1
+        print '-' * 40, 'self'
+        for frame, count in sorted(leaf.iteritems(), key=lambda x: -x[1])[:top]:
+            print '{:6.1f}%  {}'.format(100.0 * count / count_all, frame)
+        print '-' * 40, 'total'
+        for frame, count in sorted(total.iteritems(), key=lambda x: -x[1])[:top]:
+            print '{:6.1f}%  {}'.format(100.0 * count / count_all, frame)
+
+
+@manager.option('-d', '--database', dest='database', default=None,
+                help=u'SQLAlchemy url (default: sqlite file in tmp/)')
+@manager.option('-r', '--rows', dest='rows', default=10000)
+@manager.option('-n', '--requests', dest='requests', default=1000)
+@manager.option('-c', '--concurrency', dest='concurrency', default=10)
+@manager.option('-s', '--scenarios', dest='scenarios', default='list,detail,filter,sort')
+@manager.option('-m', '--modes', dest='modes', default='client,gevent')
+@manager.option('-o', '--output', dest='output', default=None, help=u'JSON file (default: stdout)')
+def bench(database=None, rows=10000, requests=1000, concurrency=10,
+          scenarios='list,detail,filter,sort', modes='client,gevent', output=None):
+    u""" 压测 API (列表/详情/过滤/排序), 结果输出为 JSON """
+    import json
+    from bench import suite
+
+    report = suite.run(database=database, rows=int(rows), requests=int(requests),
+                       concurrency=int(concurrency), scenarios=scenarios.split(','),
+                       modes=modes.split(','))
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(data)
+        print '>>> Report written: {}'.format(output)
+    else:
+        print data
+
+
 @manager.command
 def run(port):
     u""" 运行 Debug 服务器 """
@@ -0,0 +1,36 @@
+#coding: utf-8
+
+"""
+The boilerplate leaves `gvars` (and `utils.common`) to the project. Fill in
+minimal ones when they are missing, before the tested modules import them,
+so `py.test tests` runs on the tree as is.
+"""
+
+import os
+import sys
+import time
+import types
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gvars
+
+if not hasattr(gvars, 'db'):
+    import statsd
+    from flask_sqlalchemy import SQLAlchemy
+    from flask_cache import Cache
+
+    gvars.db = SQLAlchemy()
+    gvars.cache = Cache(config={'CACHE_TYPE': 'simple'})
+    gvars.statsd_client = statsd.StatsClient('127.0.0.1', 8125)
+
+try:
+    import utils.common
+except ImportError:
+    import utils
+
+    common = types.ModuleType('utils.common')
+    common.datetime_to_utcts = lambda value: int(time.mktime(value.timetuple()))
+    common.get_stdout_logger = logging.getLogger
+    sys.modules['utils.common'] = utils.common = common
@@ -0,0 +1,110 @@
+#coding: utf-8
+
+"""
+Write-behind round trip over the in-memory kombu transport:
+`utils.saver.save` -> `Publisher` -> `workers.saver.Saver` -> SQLite
+
+    cd server && py.test tests
+"""
+
+import os
+import uuid
+import json
+import signal
+import threading
+from datetime import datetime
+
+import pytest
+from kombu import Connection
+
+from gvars import db
+from bench.common import create_app, BenchItem
+from utils import saver
+from cache import api_cache
+from utils.saver import mq_queue
+from workers.saver import Saver, model_tables
+
+
+@pytest.fixture
+def app(request, monkeypatch):
+    # A queue per test, and a publisher bound to it
+    app = create_app('sqlite://', SAVER_MQ_URL='memory://',
+                     SAVER_QUEUE='saver-test-{}'.format(uuid.uuid4().hex))
+    monkeypatch.setattr(saver, '_publisher', None)
+    ctx = app.app_context()
+    ctx.push()
+    db.create_all()
+    def teardown():
+        db.session.remove()
+        db.drop_all()
+        ctx.pop()
+    request.addfinalizer(teardown)
+    return app
+
+
+def make_saver(app, **kwargs):
+    conn = Connection(app.config['SAVER_MQ_URL'])
+    return Saver(conn, mq_queue(app.config), model_tables(), **kwargs)
+
+
+def test_round_trip(app, tmpdir):
+    created_at = datetime(2016, 10, 1, 12, 30, 15, 123456)
+    rows = [{'name': u'item-{}'.format(i), 'category': i % 3, 'price': i * 1.5}
+            for i in xrange(30)]
+    assert saver.save(BenchItem, rows)
+    assert saver.save(BenchItem, {'name': u'stamped', 'category': 1, 'created_at': created_at})
+    # Invalid: a required column is missing
+    assert saver.save(BenchItem, {'name': u'bad'})
+    assert saver.get_publisher().flush()
+
+    worker = make_saver(app, batch_size=10, interval=0.1, backup_dir=str(tmpdir))
+    threading.Timer(0.5, worker.stop).start()
+    worker.run()
+
+    assert BenchItem.query.count() == 31
+    item = BenchItem.query.filter_by(name=u'item-7').one()
+    assert (item.category, float(item.price)) == (1, 10.5)
+    assert item.created_at is not None
+    assert BenchItem.query.filter_by(name=u'stamped').one().created_at == created_at
+
+    backups = tmpdir.listdir()
+    assert len(backups) == 1
+    failed = json.loads(backups[0].read())['rows']
+    assert [(table, row['name']) for table, row in failed] == [('bench_item', u'bad')]
+
+
+def test_sigint_drains(app):
+    rows = [{'name': u'item-{}'.format(i), 'category': 1} for i in xrange(20)]
+    assert saver.save(BenchItem, rows)
+    assert saver.get_publisher().flush()
+
+    # Neither the batch size nor the interval is reached: only the stop flushes
+    worker = make_saver(app, batch_size=1000, interval=60)
+    handler = signal.signal(signal.SIGINT, worker.stop)
+    try:
+        threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGINT)).start()
+        worker.run()
+    finally:
+        signal.signal(signal.SIGINT, handler)
+
+    assert worker.stopping
+    assert BenchItem.query.count() == 20
+    assert not worker.messages and not worker.rows
+    # Acked: nothing is delivered again
+    again = make_saver(app, batch_size=1000, interval=0.1)
+    threading.Timer(0.3, again.stop).start()
+    again.run()
+    assert BenchItem.query.count() == 20
+
+
+def test_bumps_list_version(app, monkeypatch):
+    bumped = []
+    monkeypatch.setattr(api_cache, 'is_list_cacheable', lambda Model: True)
+    monkeypatch.setattr(api_cache, 'bump_versions', bumped.extend)
+    assert saver.save(BenchItem, {'name': u'cached', 'category': 1})
+    assert saver.get_publisher().flush()
+
+    worker = make_saver(app, batch_size=10, interval=0.1)
+    threading.Timer(0.5, worker.stop).start()
+    worker.run()
+    assert bumped == [BenchItem]
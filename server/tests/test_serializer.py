@@ -0,0 +1,101 @@
+#coding: utf-8
+
+"""
+The compiled `ModelSerializer` against the generic `to_dict` it replaced
+
+    cd server && py.test tests
+"""
+
+import decimal
+from datetime import datetime, date, timedelta
+
+import pytest
+from sqlalchemy.types import TypeDecorator
+
+from gvars import db
+from bench.common import create_app
+from utils.common import datetime_to_utcts
+from utils.model import BaseModel, ModelSerializer, StrippedString, get_serializer
+
+
+class Upper(TypeDecorator):
+    impl = db.String
+
+    def process_result_value(self, value, dialect):
+        return value.upper() if value else value
+
+
+class Sample(BaseModel):
+    __tablename__ = 'serializer_sample'
+
+    name = db.Column(StrippedString(32))
+    code = db.Column(Upper(32))
+    price = db.Column(db.Numeric(10, 2))
+    ratio = db.Column(db.Float)
+    flag = db.Column(db.Boolean)
+    day = db.Column(db.Date)
+    duration = db.Column(db.Interval)
+
+
+def legacy_to_dict(obj):
+    data = {}
+    for c in obj.__class__.__table__.columns:
+        value = getattr(obj, c.name)
+        if isinstance(value, decimal.Decimal):
+            value = float(value)
+        elif isinstance(value, datetime):
+            data['{}_str'.format(c.name)] = value.strftime("%Y-%m-%d %H:%M:%S")
+            value = datetime_to_utcts(value)
+        elif isinstance(value, date):
+            data['{}_str'.format(c.name)] = value.strftime("%Y-%m-%d")
+            value = datetime_to_utcts(value)
+        data[c.name] = value
+    return data
+
+
+@pytest.fixture
+def app(request):
+    app = create_app('sqlite://')
+    ctx = app.app_context()
+    ctx.push()
+    db.create_all()
+    def teardown():
+        db.session.remove()
+        db.drop_all()
+        ctx.pop()
+    request.addfinalizer(teardown)
+    return app
+
+
+def test_column_kinds():
+    kinds = dict((name, kind) for name, getter, name_str, kind in get_serializer(Sample).fields)
+    assert kinds['name'] == ModelSerializer.PLAIN
+    assert kinds['created_at'] == ModelSerializer.DATETIME
+    assert kinds['day'] == ModelSerializer.DATE
+    assert kinds['price'] == ModelSerializer.DECIMAL
+    # Decorators that change the loaded value take the generic path
+    assert kinds['code'] == ModelSerializer.ANY
+    assert kinds['duration'] == ModelSerializer.ANY
+
+
+def test_parity(app):
+    db.session.add_all([
+        Sample(name=u' 名字 ', code=u'ab', price=decimal.Decimal('12.30'), ratio=0.5,
+               flag=True, day=date(2016, 10, 1), duration=timedelta(hours=1, seconds=5),
+               updated_at=datetime(2016, 10, 2, 8, 30, 1, 500)),
+        Sample(),
+    ])
+    db.session.commit()
+    db.session.expire_all()
+    objs = Sample.query.order_by(Sample.id).all()
+    assert objs[0].duration == timedelta(hours=1, seconds=5)
+    for obj in objs:
+        assert obj.to_dict() == legacy_to_dict(obj)
+    assert get_serializer(Sample).serialize_many(objs) == [legacy_to_dict(obj) for obj in objs]
+
+    names = ['duration', 'day', 'price']
+    rows = Sample.query.with_entities(Sample.duration, Sample.day, Sample.price) \
+                       .order_by(Sample.id).all()
+    assert get_serializer(Sample).serialize_many(rows, names) == [
+        dict((key, value) for key, value in legacy_to_dict(obj).items()
+             if key.split('_str')[0] in names) for obj in objs]
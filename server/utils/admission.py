@@ -0,0 +1,160 @@
+#coding: utf-8
+
+"""
+Admission control: bound the requests a worker runs at once so an overload
+is shed with a fast 503 (+ Retry-After) instead of queueing greenlets on the
+DB pool until gunicorn's `timeout` kills the worker.
+
+  ADMISSION_CONTROL       : Enable (default: False)
+  ADMISSION_LIMIT         : Concurrent requests per endpoint (default: 20)
+  ADMISSION_LIMITS        : {endpoint: limit} overrides of ADMISSION_LIMIT
+  ADMISSION_WORKER_LIMIT  : Concurrent requests per worker, e.g. the DB pool
+                            size + max_overflow (default: None, no limit)
+  ADMISSION_QUEUE         : Requests waiting per endpoint/worker (default: 50)
+  ADMISSION_TIMEOUT       : Seconds a request may wait for a slot (default: 1)
+  ADMISSION_RETRY_AFTER   : Retry-After (seconds) of the 503 (default: 1)
+  ADMISSION_SHED          : {priority: fraction of ADMISSION_QUEUE} a priority
+                            class may fill before it is shed without waiting
+                            (default: {'high': 1.0, 'normal': 0.5, 'low': 0.2})
+
+Waiting requests get the next free slot by priority ('high' first), see
+`BaseMethodView.priority` for how requests are classed.
+"""
+
+import time
+import heapq
+import itertools
+import threading
+
+from flask import request, current_app
+
+from gvars import statsd_client
+from utils.exceptions import ServiceUnavailable
+
+
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+DEFAULT_SHED = {'high': 1.0, 'normal': 0.5, 'low': 0.2}
+
+
+class _Waiter(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+
+
+class Limiter(object):
+    """ A semaphore with a bounded, prioritized wait queue, see
+    `utils.background` for the waiting under gevent. """
+
+    def __init__(self, limit, queue_size):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._counter = itertools.count()
+
+    def acquire(self, priority, timeout, shed_at=1.0):
+        """ Return True when a slot is taken, False when shed or timed out """
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                return True
+            if len(self._waiters) >= self.queue_size * shed_at or timeout <= 0:
+                return False
+            waiter = _Waiter()
+            entry = (PRIORITIES.get(priority, 1), next(self._counter), waiter)
+            heapq.heappush(self._waiters, entry)
+
+        waiter.event.wait(timeout)
+        with self._lock:
+            # A slot may have been handed over right after the timeout
+            if not waiter.granted:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            return waiter.granted
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # Hand the slot over, `active` stays the same
+                _, _, waiter = heapq.heappop(self._waiters)
+                waiter.granted = True
+                waiter.event.set()
+            else:
+                self.active -= 1
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(key, limit, queue_size):
+    limiter = _limiters.get(key)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.setdefault(key, Limiter(limit, queue_size))
+    return limiter
+
+
+class Slot(object):
+    """ The limiters a request holds, release once the response is done """
+
+    def __init__(self):
+        self.limiters = []
+
+    def release(self):
+        while self.limiters:
+            self.limiters.pop().release()
+
+
+def request_priority(app):
+    view_func = app.view_functions.get(request.endpoint)
+    view_class = getattr(view_func, 'view_class', None)
+    if view_class is not None and hasattr(view_class, 'request_priority'):
+        return view_class.request_priority()
+    return 'normal'
+
+
+def acquire(app):
+    """ Take the slots for the current request, return a `Slot` (or None when
+    admission control is off) or raise `ServiceUnavailable` """
+    config = app.config
+    endpoint = request.endpoint
+    if not config.get('ADMISSION_CONTROL', False) or endpoint is None:
+        return None
+
+    priority = request_priority(app)
+    shed_at = config.get('ADMISSION_SHED', DEFAULT_SHED).get(priority, 1.0)
+    queue_size = config.get('ADMISSION_QUEUE', 50)
+    limit = config.get('ADMISSION_LIMITS', {}).get(
+        endpoint, config.get('ADMISSION_LIMIT', 20))
+    limiters = [get_limiter(endpoint, limit, queue_size)]
+    worker_limit = config.get('ADMISSION_WORKER_LIMIT')
+    if worker_limit:
+        limiters.append(get_limiter(None, worker_limit, queue_size))
+
+    start = time.time()
+    deadline = start + config.get('ADMISSION_TIMEOUT', 1)
+    slot = Slot()
+    for limiter in limiters:
+        if not limiter.acquire(priority, deadline - time.time(), shed_at):
+            slot.release()
+            statsd_client.incr('admission.{}.shed.{}'.format(endpoint, priority))
+            current_app.logger.warning(u'Shed request: endpoint={}, priority={}'.format(
+                endpoint, priority))
+            raise ServiceUnavailable(retry_after=config.get('ADMISSION_RETRY_AFTER', 1))
+        slot.limiters.append(limiter)
+    statsd_client.timing('admission.{}.wait'.format(endpoint),
+                         int((time.time() - start) * 1000))
+    return slot
+
+
+def release(slot, response=None):
+    """ A streamed response keeps its slots until the body is sent """
+    if slot is None:
+        return
+    if response is not None and response.is_streamed:
+        response.call_on_close(slot.release)
+    else:
+        slot.release()
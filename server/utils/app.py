@@ -1,19 +1,33 @@
 #coding: utf-8
 
-import json
+import logging
+import hashlib
+from datetime import datetime
+from collections import OrderedDict
 
-from werkzeug.http import HTTP_STATUS_CODES
+from werkzeug.http import HTTP_STATUS_CODES, http_date, quote_etag
 from werkzeug.exceptions import HTTPException
 from werkzeug.wrappers import Response as ResponseBase
 # from werkzeug.routing import RequestRedirect
 from flask import Flask as FlaskBase
-from flask import request, current_app
+from flask import request, current_app, abort, g
 from flask.views import MethodView
+from sqlalchemy import inspect
 import IP
 
-from gvars import statsd_client
-from utils.model import QueryProcessor
-from utils.exceptions import PageOverflow
+from gvars import db, statsd_client
+from utils.model import QueryProcessor, SessionMixin, get_serializer
+from utils.common import datetime_to_utcts
+from utils.encoder import get_dumps
+from utils import bulk
+from utils.metrics import METRICS, timed, check_query_count, start_request, send_request_metrics
+from utils.routing import mark_written, primary_reads
+from utils import profiler
+from utils import admission
+from utils import warmup
+from utils import reqlog
+from utils.exceptions import PageOverflow, BadRequest, ServiceUnavailable
+from cache import api_cache, single_flight
 
 
 class BaseMethodView(MethodView):
@@ -31,6 +45,48 @@ class BaseMethodView(MethodView):
     # Default data model (subclass of Flask-SQLAlchemy.Model)
     Model = None
 
+    # Send ETag/Last-Modified (from `updated_at`/`created_at`) on detail GET
+    # responses and answer 304 to matching conditional requests. The
+    # timestamps are read with a primary key query before `get_one`, so a
+    # 304 skips loading and serializing the object.
+    conditional_get = True
+
+    # Also for list GETs: the ETag comes from the list cache version (see
+    # `cache.api_cache`), else from an extra max/count query, which is only
+    # run for the 'exact' total strategy
+    conditional_list_get = False
+
+    # Accept bulk writes (POST/PUT/DELETE with a JSON array) to the list url
+    bulk_write = False
+
+    # Answer `?ids=1,2,3` on the list url with `get_many`. It reads from
+    # `Model.query` and the detail cache, not through `get_list`/`get_one`,
+    # so leave it off for views that override those to scope the records.
+    batch_read = False
+
+    # GET/HEAD may read from a replica (with `utils.routing.RoutingSQLAlchemy`)
+    read_replica = True
+
+    # Request metrics sent to statsd, see `utils.metrics` (empty: none)
+    metrics = METRICS
+
+    # Admission control class ('high', 'normal' or 'low') per kind of
+    # request, see `utils.admission`. Under overload 'low' is shed first.
+    priority = {'detail': 'high', 'write': 'normal', 'list': 'low', 'export': 'low'}
+
+    @classmethod
+    def as_view(cls, name, *class_args, **class_kwargs):
+        """ The view function, its `methods` leave out the bulk write
+        handlers of this class unless `bulk_write` is set """
+        view = MethodView.as_view.__func__(cls, name, *class_args, **class_kwargs)
+        methods = set(cls.methods or [])
+        if not cls.bulk_write:
+            for method in ('post', 'put', 'delete'):
+                if getattr(cls, method).__func__ is getattr(BaseMethodView, method).__func__:
+                    methods.discard(method.upper())
+        view.methods = sorted(methods)
+        return view
+
     @classmethod
     def register_urls(cls, bp=None):
         """ Call this classmethod before register blueprints to flask app:
@@ -48,21 +104,308 @@ class BaseMethodView(MethodView):
             kwargs.setdefault('view_func', view)
             bp.add_url_rule(*args, **kwargs)
 
+    @classmethod
+    def request_priority(cls):
+        if request.method not in ('GET', 'HEAD'):
+            kind = 'write'
+        elif any(v is not None for v in (request.view_args or {}).values()):
+            kind = 'detail'
+        elif cls.is_export():
+            kind = 'export'
+        else:
+            kind = 'list'
+        return cls.priority.get(kind, 'normal')
+
+    @staticmethod
+    def is_export():
+        """ Whether `q` asks for an export (a bad `q` is rejected later) """
+        try:
+            args = QueryProcessor.parse_args(request)
+        except BadRequest:
+            return False
+        return args.get('export') is not None
+
+    def dispatch_request(self, *args, **kwargs):
+        g.db_read_only = self.read_replica and request.method in ('GET', 'HEAD')
+        g.metrics = self.metrics
+        return MethodView.dispatch_request(self, *args, **kwargs)
+
     def get_list(self):
         """ Default method for get a page of objects  """
         return QueryProcessor.build(request, self.Model)
 
     # FIXME: For permission controls
     def get_one(self, oid):
-        """ Get object by id (primary key)"""
-        obj = self.Model.query.get_or_404(oid)
-        return obj.to_dict()
+        """ Get object by id (primary key), `fields` in `q` selects the columns """
+        Model = self.Model
+        fields = QueryProcessor.parse_args(request).get('fields')
+        if fields:
+            columns = QueryProcessor.field_columns(Model, fields)
+            pk = Model.__mapper__.primary_key[0]
+            row = Model.query.with_entities(*columns).filter(pk == oid).first()
+            if row is None:
+                abort(404)
+            with timed('serialize'):
+                return get_serializer(Model).serialize(row, fields)
+        key = 'obj:{}:{}'.format(Model.__tablename__, oid)
+        def load_one():
+            obj = Model.query.get_or_404(oid)
+            with timed('serialize'):
+                return obj.to_dict()
+        def load():
+            return single_flight.do(key, load_one)
+        if api_cache.is_cacheable(Model):
+            return api_cache.get_object(Model, oid, load)
+        return load()
+
+    def cast_ids(self, values):
+        """ `values` (strings or JSON scalars) cast to the primary key type """
+        pk = self.Model.__mapper__.primary_key[0]
+        try:
+            cast = pk.type.python_type
+        except NotImplementedError:
+            cast = unicode
+        ids = []
+        for value in values:
+            try:
+                if isinstance(value, basestring):
+                    oid = cast(value.strip())
+                elif value is None or isinstance(value, (bool, dict, list)):
+                    raise ValueError(value)
+                else:
+                    oid = cast(value)
+                    if oid != value:
+                        raise ValueError(value)
+            except (ValueError, TypeError):
+                raise BadRequest(u'ids 参数错误: {}'.format(value))
+            ids.append(oid)
+        return ids
+
+    def parse_ids(self, value):
+        """ Ids of `?ids=1,2,3` cast to the primary key type """
+        ids = self.cast_ids(v for v in value.split(',') if v.strip())
+        max_ids = current_app.config.get('BATCH_MAX_IDS', 100)
+        if len(ids) > max_ids:
+            raise BadRequest(u'ids 数量超过限制: {}'.format(max_ids))
+        return ids
+
+    def get_many(self, ids):
+        """ Get objects by ids in request order, `null` for ids not found.
+
+        Objects already loaded in the session or cached are reused, the rest
+        are loaded with one `IN` query and serialized in one pass.
+        """
+        Model = self.Model
+        mapper = Model.__mapper__
+        cacheable = api_cache.is_cacheable(Model)
+        unique_ids = list(OrderedDict.fromkeys(ids))
+        found = api_cache.get_objects(Model, unique_ids) if cacheable else {}
+
+        objs = []
+        missing = []
+        identity_map = db.session.identity_map
+        for oid in unique_ids:
+            if oid in found:
+                continue
+            obj = identity_map.get(mapper.identity_key_from_primary_key([oid]))
+            # Expired objects would be refreshed one by one
+            if obj is not None and not inspect(obj).expired_attributes:
+                objs.append(obj)
+            else:
+                missing.append(oid)
+        fetched = []
+        if missing:
+            pk = mapper.primary_key[0]
+            query = Model.query.filter(pk.in_(missing))
+            if cacheable:
+                # Cached for other clients, not from a lagging replica
+                with primary_reads():
+                    fetched = query.all()
+            else:
+                fetched = query.all()
+            objs.extend(fetched)
+
+        with timed('serialize'):
+            if Model.to_dict.__func__ is SessionMixin.to_dict.__func__:
+                dicts = get_serializer(Model).serialize_many(objs)
+            else:
+                dicts = [obj.to_dict() for obj in objs]
+        loaded = dict((mapper.primary_key_from_instance(obj)[0], data)
+                      for obj, data in zip(objs, dicts))
+        if cacheable and fetched:
+            api_cache.set_objects(Model, dict(
+                (oid, loaded[oid]) for oid in
+                (mapper.primary_key_from_instance(obj)[0] for obj in fetched)))
+        found.update(loaded)
+        return {
+            'objects': [found.get(oid) for oid in ids],
+            'not_found': [oid for oid in unique_ids if oid not in found],
+        }
+
+    def bulk_items(self):
+        if not self.bulk_write:
+            abort(405)
+        items = request.get_json(force=True, silent=True)
+        if not isinstance(items, list):
+            raise BadRequest(u'请求体必须是 JSON 数组')
+        max_items = current_app.config.get('BULK_MAX_ITEMS', 10000)
+        if len(items) > max_items:
+            raise BadRequest(u'数量超过限制: {}'.format(max_items))
+        return items
+
+    def bulk_done(self, ids=()):
+        """ Core statements skip the ORM events, drop the caches here """
+        Model = self.Model
+        db.session.commit()
+        mark_written()
+        if api_cache.is_cacheable(Model):
+            for oid in ids:
+                api_cache.invalidate(Model, oid)
+        if api_cache.is_list_cacheable(Model):
+            api_cache.bump_versions([Model])
+
+    @staticmethod
+    def bulk_results(count, errors, results):
+        return {'results': [{'ok': False, 'error': errors[i]} if i in errors
+                            else results.get(i, {'ok': True}) for i in xrange(count)]}
+
+    def bulk_create(self, items):
+        """ Create objects (upsert when `Meta.bulk_upsert_on` is set) """
+        Model = self.Model
+        upsert_on = getattr(getattr(Model, 'Meta', None), 'bulk_upsert_on', None)
+        valid, errors = bulk.validate_items(Model, items)
+        ids, db_errors = bulk.insert(Model, [values for i, values in valid], upsert_on=upsert_on)
+        results = {}
+        for n, ((i, values), oid) in enumerate(zip(valid, ids)):
+            if n in db_errors:
+                errors[i] = db_errors[n]
+            else:
+                results[i] = {'ok': True, 'id': oid}
+        self.bulk_done([oid for oid in ids if oid is not None] if upsert_on else ())
+        return self.bulk_results(len(items), errors, results)
+
+    def bulk_update(self, items):
+        """ Update objects by primary key, ids not found are reported per item """
+        Model = self.Model
+        pk = Model.__mapper__.primary_key[0]
+        valid, errors = bulk.validate_items(Model, items, with_pk=True)
+        existing = bulk.existing_ids(Model, [values[pk.name] for i, values in valid])
+        for i, values in valid:
+            if values[pk.name] not in existing:
+                errors[i] = u'不存在: {}'.format(values[pk.name])
+        valid = [(i, values) for i, values in valid if i not in errors]
+        db_errors = bulk.update(Model, [values for i, values in valid])
+        for n, (i, values) in enumerate(valid):
+            if n in db_errors:
+                errors[i] = db_errors[n]
+        self.bulk_done(existing)
+        return self.bulk_results(len(items), errors, {})
+
+    def bulk_delete(self, ids):
+        Model = self.Model
+        existing = bulk.existing_ids(Model, ids)
+        targets = [oid for oid in OrderedDict.fromkeys(ids) if oid in existing]
+        failed = dict((targets[n], error) for n, error in
+                      bulk.delete(Model, targets).iteritems())
+        self.bulk_done(existing)
+        errors = {}
+        for i, oid in enumerate(ids):
+            if oid not in existing:
+                errors[i] = u'不存在: {}'.format(oid)
+            elif oid in failed:
+                errors[i] = failed[oid]
+        return self.bulk_results(len(ids), errors, {})
+
+    def post(self, oid=None):
+        if oid is not None:
+            abort(405)
+        return self.bulk_create(self.bulk_items())
+
+    def put(self, oid=None):
+        if oid is not None:
+            abort(405)
+        return self.bulk_update(self.bulk_items())
+
+    def delete(self, oid=None):
+        if oid is not None:
+            abort(405)
+        if request.args.get('ids'):
+            if not self.bulk_write:
+                abort(405)
+            ids = self.parse_ids(request.args['ids'])
+        else:
+            ids = self.cast_ids(self.bulk_items())
+        return self.bulk_delete(ids)
+
+    @staticmethod
+    def conditional(rv, etag, last_modified=None):
+        """ `rv` with the validators, or an empty 304 when the request matches """
+        headers = {'ETag': quote_etag(etag)}
+        if last_modified is not None:
+            # HTTP dates have a resolution of seconds
+            last_modified = last_modified.replace(microsecond=0)
+            headers['Last-Modified'] = http_date(last_modified)
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        elif request.if_modified_since and last_modified is not None:
+            not_modified = last_modified <= request.if_modified_since
+        else:
+            not_modified = False
+        if not_modified:
+            return '', 304, headers
+        return rv, 200, headers
+
+    def conditional_list(self, processor):
+        """ Validators of the list come from the list cache version or an
+        aggregate query, so a 304 is answered before the page is fetched and
+        serialized. """
+        if processor.export:
+            return processor
+        if api_cache.is_list_cacheable(processor.model):
+            key = api_cache.list_key(processor)
+            if key is None:
+                return processor
+            return self.conditional(processor, hashlib.md5(key).hexdigest())
+        if processor.total_strategy != 'exact' or not hasattr(self.Model, 'updated_at'):
+            return processor
+        etag, last_modified = processor.validators()
+        return self.conditional(processor, etag, last_modified)
+
+    def validators_one(self, oid):
+        """ (etag, last_modified) of an object from its full resolution
+        `updated_at`/`created_at`, None when it has no timestamp or does not
+        exist (left to `get_one`). """
+        Model = self.Model
+        stamps = [getattr(Model, name) for name in ('updated_at', 'created_at')
+                  if hasattr(Model, name)]
+        if not stamps:
+            return None
+        pk = Model.__mapper__.primary_key[0]
+        row = Model.query.with_entities(*stamps).filter(pk == oid).first()
+        modified = next((value for value in row if value is not None), None) if row else None
+        if modified is None:
+            return None
+        etag = hashlib.md5(u'{}:{}:{}:{}'.format(
+            Model.__tablename__, oid, modified.isoformat(),
+            request.args.get('q', u'')).encode('utf-8')).hexdigest()
+        return etag, datetime.utcfromtimestamp(datetime_to_utcts(modified))
 
     def get(self, oid):
-        if oid is None:
-            return self.get_list()
+        if oid is None and self.batch_read and request.args.get('ids'):
+            return self.get_many(self.parse_ids(request.args['ids']))
+        elif oid is None:
+            rv = self.get_list()
+            if self.conditional_list_get and isinstance(rv, QueryProcessor):
+                rv = self.conditional_list(rv)
+            return rv
         else:
-            return self.get_one(oid)
+            validators = self.validators_one(oid) if self.conditional_get else None
+            if validators is None:
+                return self.get_one(oid)
+            rv, status, headers = self.conditional(None, *validators)
+            if status == 304:
+                return rv, status, headers
+            return self.get_one(oid), status, headers
 
 
 class MyResponse(ResponseBase):
@@ -72,12 +415,37 @@ class MyResponse(ResponseBase):
 class MyFlask(FlaskBase):
     response_class = MyResponse
 
+    def full_dispatch_request(self):
+        start_request()
+        try:
+            slot = admission.acquire(self)
+        except ServiceUnavailable as e:
+            response = self.make_response((e, None, {'Retry-After': str(e.retry_after)}))
+            send_request_metrics(response)
+            reqlog.log_request(self, response)
+            return response
+        sampler = profiler.start_request()
+        response = None
+        try:
+            response = FlaskBase.full_dispatch_request(self)
+        finally:
+            profiler.finish_request(sampler)
+            admission.release(slot, response)
+        send_request_metrics(response)
+        reqlog.log_request(self, response)
+        warmup.first_request_done()
+        return response
+
     def make_response(self, rv):
         status = headers = None
         if isinstance(rv, tuple):
             rv, status, headers = rv + (None,) * (3 - len(rv))
-        current_app.logger.debug(u'Response(original): rv={}, status={}, headers={}'.format(
-            rv, status, headers))
+        logger = current_app.logger
+        # Formatting a large response body is expensive, only do it for DEBUG
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(u'Response(original): rv={}, status={}, headers={}'.format(
+                rv, status, headers))
 
         if isinstance(rv, HTTPException):
             message = rv.response.data if rv.response else HTTP_STATUS_CODES[rv.code]
@@ -85,19 +453,35 @@ class MyFlask(FlaskBase):
             rv = {'message': message}
         elif isinstance(rv, QueryProcessor):
             try:
-                rv = rv.get_rv()
+                processor = rv
+                if processor.export:
+                    rv = processor.export_response()
+                else:
+                    if api_cache.is_list_cacheable(processor.model):
+                        get_rv = lambda: api_cache.get_list(processor)
+                    else:
+                        get_rv = processor.get_rv
+                    rv = single_flight.do('list:{}:{}'.format(
+                        processor.model.__tablename__, processor.query_hash()), get_rv)
             except PageOverflow as e:
                 status = e.code
                 rv = {'message': e.message}
+            except HTTPException as e:
+                # Raised after the view returned (bad field/operator/cursor),
+                # so Flask's error handlers won't see it.
+                return self.make_response(e)
 
         # Dump return data as JSON string.
         if isinstance(rv, (dict, list, tuple)):
-            rv = json.dumps(rv)
+            with timed('serialize'):
+                rv = get_dumps(current_app.config.get('JSON_BACKEND', 'auto'))(rv)
 
         if status >= 400:
-            statsd_client.incr('{}.endpint.{}.{}'.format(
+            statsd_client.incr('{}.endpoint.{}.{}'.format(
                 status, request.endpoint, request.method))
 
-        current_app.logger.debug(u'Response(final): rv={}, status={}, headers={}'.format(
-            rv, status, headers))
+        check_query_count()
+        if debug:
+            logger.debug(u'Response(final): rv={}, status={}, headers={}'.format(
+                rv, status, headers))
         return FlaskBase.make_response(self, (rv, status, headers))
@@ -0,0 +1,97 @@
+#coding: utf-8
+
+"""
+Background writers for work a request hands off and never waits for (the
+request log, the write-behind rows of `utils.saver`): a bounded queue
+drained in batches by a daemon thread. Items that don't fit in the queue
+are dropped and counted.
+
+Under the gevent worker `threading` is monkey patched: a thread is a
+greenlet and a lock or event only blocks the greenlet waiting on it, so the
+`threading` based code here (and in `cache.single_flight`, `utils.admission`)
+waits per greenlet. Blocking calls gevent can not make cooperative (file
+I/O) go through `run_blocking`, which moves them to the gevent threadpool.
+"""
+
+import os
+import sys
+import time
+import threading
+from Queue import Queue, Full, Empty
+
+from gvars import statsd_client
+
+
+def gevent_patched():
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def run_blocking(func, *args):
+    """ `func(*args)` in a real OS thread under gevent, else directly """
+    if gevent_patched():
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+
+class BackgroundWriter(object):
+    """ Subclasses implement `write(items)`. `dropped_metric` is the statsd
+    counter of the dropped items, sent by the writer thread. """
+
+    name = 'background-writer'
+    dropped_metric = None
+
+    def __init__(self, maxsize=10000, batch_size=500, logger=None):
+        self.batch_size = batch_size
+        self.logger = logger
+        self.queue = Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, item):
+        """ Never blocks, returns False when the item was dropped """
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except Full:
+            self.dropped += 1
+            return False
+
+    def take(self, timeout=None):
+        items = [self.queue.get(timeout=timeout)]
+        while len(items) < self.batch_size:
+            try:
+                items.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return items
+
+    def write(self, items):
+        raise NotImplementedError
+
+    def run(self):
+        dropped = 0
+        while True:
+            items = self.take()
+            try:
+                self.write(items)
+            except Exception:
+                if self.logger:
+                    self.logger.exception(u'Background write failed: {}'.format(self.name))
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+            if self.dropped != dropped and self.dropped_metric:
+                statsd_client.incr(self.dropped_metric, self.dropped - dropped)
+                dropped = self.dropped
+
+    def flush(self, timeout=5):
+        """ Wait (at most `timeout` seconds) for the queued items to be written """
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+        return not self.queue.unfinished_tasks
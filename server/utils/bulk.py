@@ -0,0 +1,325 @@
+#coding: utf-8
+
+"""
+Bulk persistence behind the bulk writes of `BaseMethodView`.
+
+Rows go through SQLAlchemy Core (multi-row INSERT ... RETURNING on Postgres,
+`executemany` elsewhere), so the bind processing of the column types
+(`StrippedString`) and the python side defaults (`created_at`, `updated_at`)
+behave as on the ORM path. Large plain inserts on Postgres use COPY, for
+which the same processing is applied by hand.
+
+Values are checked (and cast) against the column types first. Each chunk
+runs in a savepoint: when the database rejects it (unique/foreign key
+violation, bad value) it is rolled back and its rows are retried one by one,
+so only the bad rows are reported as failed. pysqlite can not roll back to a
+savepoint, on SQLite a rejected chunk fails the whole request.
+
+Model Meta options:
+  bulk_upsert_on = ['code']   # INSERT ... ON CONFLICT (code) DO UPDATE, Postgres only
+"""
+
+import json
+import decimal
+from datetime import datetime, date
+from cStringIO import StringIO
+from collections import OrderedDict
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import DBAPIError, IntegrityError, DataError
+from sqlalchemy.types import TypeDecorator
+from flask import current_app
+
+from gvars import db
+
+
+# Filled by the database / column defaults, not by clients
+READONLY_COLUMNS = ('created_at', 'updated_at')
+
+
+def cast_value(column, value):
+    """ The JSON `value` as the python type of `column`, ValueError when it
+    does not fit. Date/time values are the timestamps or `*_str` strings of
+    `to_dict`. Unknown column types are left to the database. """
+    type_ = column.type
+    if isinstance(type_, TypeDecorator):
+        type_ = type_.impl
+    if value is None:
+        if not column.nullable:
+            raise ValueError(u'不能为空')
+        return value
+    number = isinstance(value, (int, long, float)) and not isinstance(value, bool)
+    if isinstance(type_, db.Boolean):
+        if not isinstance(value, bool):
+            raise ValueError(u'应为布尔值')
+    elif isinstance(type_, db.Integer):
+        if not isinstance(value, (int, long)) or isinstance(value, bool):
+            raise ValueError(u'应为整数')
+    elif isinstance(type_, db.Numeric):
+        if isinstance(value, basestring):
+            try:
+                value = decimal.Decimal(value)
+            except decimal.InvalidOperation:
+                raise ValueError(u'应为数字')
+            if not value.is_finite():
+                raise ValueError(u'应为数字')
+        elif not number and not isinstance(value, decimal.Decimal):
+            raise ValueError(u'应为数字')
+    elif isinstance(type_, db.String):
+        if not isinstance(value, basestring):
+            raise ValueError(u'应为字符串')
+        if isinstance(type_, db.Enum) and value not in type_.enums:
+            raise ValueError(u'应为: {}'.format(u', '.join(type_.enums)))
+        if type_.length and len(value) > type_.length:
+            raise ValueError(u'长度超过 {}'.format(type_.length))
+    elif isinstance(type_, db.DateTime):
+        if number:
+            value = datetime.fromtimestamp(value)
+        elif isinstance(value, basestring):
+            value = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+        elif not isinstance(value, datetime):
+            raise ValueError(u'应为时间戳')
+    elif isinstance(type_, db.Date):
+        if number:
+            value = date.fromtimestamp(value)
+        elif isinstance(value, basestring):
+            value = datetime.strptime(value, '%Y-%m-%d').date()
+        elif not isinstance(value, date):
+            raise ValueError(u'应为日期')
+    return value
+
+
+def validate_items(Model, items, with_pk=False, readonly=READONLY_COLUMNS):
+    """ Check the items against the table columns and cast their values.
+
+    Returns (valid, errors): `valid` is a list of (index, values), `errors`
+    maps the index of every rejected item to its error message.
+    """
+    table = Model.__table__
+    pk = Model.__mapper__.primary_key[0]
+    valid, errors = [], {}
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[i] = u'不是 JSON 对象'
+            continue
+        unknown = [k for k in item if k not in table.c or k in readonly]
+        if unknown:
+            errors[i] = u'未知或只读字段: {}'.format(u', '.join(unknown))
+            continue
+        elif with_pk and item.get(pk.name) is None:
+            errors[i] = u'缺少主键: {}'.format(pk.name)
+            continue
+        elif not with_pk:
+            missing = [c.name for c in table.columns
+                       if not c.nullable and c.default is None and c.server_default is None
+                       and not c.primary_key and item.get(c.name) is None]
+            if missing:
+                errors[i] = u'缺少必填字段: {}'.format(u', '.join(missing))
+                continue
+        values, invalid = {}, []
+        for k, value in item.iteritems():
+            try:
+                values[k] = cast_value(table.c[k], value)
+            except (ValueError, TypeError, OverflowError) as e:
+                invalid.append(u'{}({})'.format(k, e.message if isinstance(e.message, unicode)
+                                                else u'格式错误'))
+        if invalid:
+            errors[i] = u'字段值错误: {}'.format(u', '.join(invalid))
+        else:
+            valid.append((i, values))
+    return valid, errors
+
+
+def db_error(e):
+    """ The message of a database error reported to the client """
+    return u'数据库错误: {}'.format(str(e.orig).decode('utf-8', 'replace').strip())
+
+
+def _has_savepoints():
+    return db.session.connection().dialect.name != 'sqlite'
+
+
+def execute_chunk(execute, indexes, errors):
+    """ `execute(indexes)` in a savepoint. When the database rejects the
+    chunk its rows are retried one by one, `errors` gets the failed ones. """
+    if not _has_savepoints():
+        execute(indexes)
+        return
+    try:
+        with db.session.begin_nested():
+            execute(indexes)
+    except (IntegrityError, DataError) as e:
+        if len(indexes) == 1:
+            errors[indexes[0]] = db_error(e)
+            return
+        for i in indexes:
+            execute_chunk(execute, [i], errors)
+
+
+def group_by_keys(rows):
+    """ Multi-row statements need the same columns in every row """
+    groups = OrderedDict()
+    for i, row in enumerate(rows):
+        groups.setdefault(tuple(sorted(row)), []).append(i)
+    return groups
+
+
+def chunks(lst, size):
+    for i in xrange(0, len(lst), size):
+        yield lst[i:i + size]
+
+
+def _is_postgres():
+    return db.session.connection().dialect.name == 'postgresql'
+
+
+def insert(Model, rows, upsert_on=None):
+    """ Insert `rows` (list of dicts). Returns (ids, errors): the new primary
+    keys in order (None where the database can not tell or the row failed)
+    and {row index: error} of the rows the database rejected. """
+    ids, errors = [None] * len(rows), {}
+    if not rows:
+        return ids, errors
+    table = Model.__table__
+    pk = Model.__mapper__.primary_key[0]
+    config = current_app.config
+    postgres = _is_postgres()
+    if upsert_on and not postgres:
+        raise ValueError('bulk_upsert_on needs PostgreSQL: {}'.format(Model.__name__))
+    if postgres and not upsert_on and len(rows) >= config.get('BULK_COPY_THRESHOLD', 1000):
+        try:
+            with db.session.begin_nested():
+                copy_insert(Model, rows)
+            return ids, errors
+        except (IntegrityError, DataError):
+            # Find the bad rows with the INSERT path
+            pass
+
+    chunk_size = config.get('BULK_CHUNK_SIZE', 500)
+    for keys, indexes in group_by_keys(rows).iteritems():
+        if upsert_on:
+            from sqlalchemy.dialects.postgresql import insert as pg_insert
+            stmt = pg_insert(table)
+            updates = dict((k, stmt.excluded[k]) for k in keys if k not in upsert_on)
+            updated_at = table.c.get('updated_at')
+            if updated_at is not None and updated_at.onupdate is not None:
+                # `onupdate` is not applied to ON CONFLICT DO UPDATE
+                updates['updated_at'] = updated_at.onupdate.arg(None)
+            stmt = stmt.on_conflict_do_update(index_elements=upsert_on, set_=updates)
+        else:
+            stmt = table.insert()
+
+        def execute(part, stmt=stmt):
+            values = [rows[i] for i in part]
+            if not postgres:
+                db.session.execute(stmt, values)
+                return
+            result = db.session.execute(stmt.values(values).returning(table.c[pk.name]))
+            for i, row in zip(part, result.fetchall()):
+                ids[i] = row[0]
+
+        for part in chunks(indexes, chunk_size):
+            execute_chunk(execute, part, errors)
+    return ids, errors
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif isinstance(value, date):
+        value = value.isoformat()
+    elif not isinstance(value, basestring):
+        value = unicode(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+                .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_insert(Model, rows):
+    """ COPY ... FROM STDIN, with the python defaults and bind processors of
+    the columns applied like the Core INSERT would. One COPY per column set,
+    so the columns a row leaves out get their server default. """
+    table = Model.__table__
+    conn = db.session.connection()
+    dialect = conn.dialect
+    def has_python_default(c):
+        return c.default is not None and (c.default.is_callable or c.default.is_scalar)
+
+    for keys, indexes in group_by_keys(rows).iteritems():
+        columns = [c for c in table.columns
+                   if c.name in keys or (has_python_default(c) and not c.primary_key)]
+        processors = [(c, c.type.bind_processor(dialect)) for c in columns]
+
+        buf = StringIO()
+        for i in indexes:
+            row = rows[i]
+            values = []
+            for c, process in processors:
+                if c.name in row:
+                    value = row[c.name]
+                else:
+                    value = c.default.arg(None) if c.default.is_callable else c.default.arg
+                if process is not None:
+                    value = process(value)
+                values.append(_copy_value(value))
+            buf.write('\t'.join(values) + '\n')
+        buf.seek(0)
+
+        sql = 'COPY {} ({}) FROM STDIN'.format(
+            table.name, ', '.join('"{}"'.format(c.name) for c in columns))
+        try:
+            conn.connection.cursor().copy_expert(sql, buf)
+        except dialect.dbapi.Error as e:
+            # Raised by the DBAPI cursor, wrap it like `execute` does
+            raise DBAPIError.instance(sql, None, e, dialect.dbapi.Error)
+
+
+def update(Model, rows):
+    """ Update rows by primary key with `executemany`, one statement per
+    column set. `onupdate` (updated_at) is applied by Core. Returns {row
+    index: error} of the rows the database rejected. """
+    table = Model.__table__
+    pk = Model.__mapper__.primary_key[0]
+    chunk_size = current_app.config.get('BULK_CHUNK_SIZE', 500)
+    errors = {}
+    for keys, indexes in group_by_keys(rows).iteritems():
+        columns = [k for k in keys if k != pk.name]
+        if not columns:
+            continue
+        # Bind names must not clash with the column names
+        stmt = table.update().where(table.c[pk.name] == bindparam('b_pk')).values(
+            dict((k, bindparam('b_' + k)) for k in columns))
+        def execute(part, stmt=stmt, columns=columns):
+            params = [dict([('b_pk', rows[i][pk.name])] +
+                           [('b_' + k, rows[i][k]) for k in columns]) for i in part]
+            db.session.execute(stmt, params)
+        for part in chunks(indexes, chunk_size):
+            execute_chunk(execute, part, errors)
+    return errors
+
+
+def delete(Model, ids):
+    """ Delete by primary key, returns {index of `ids`: error} of the rows
+    the database refused to delete (e.g. still referenced) """
+    table = Model.__table__
+    pk = Model.__mapper__.primary_key[0]
+    chunk_size = current_app.config.get('BULK_CHUNK_SIZE', 500)
+    errors = {}
+    def execute(part):
+        db.session.execute(table.delete().where(table.c[pk.name].in_([ids[i] for i in part])))
+    for part in chunks(range(len(ids)), chunk_size):
+        execute_chunk(execute, part, errors)
+    return errors
+
+
+def existing_ids(Model, ids):
+    pk = Model.__mapper__.primary_key[0]
+    if not ids:
+        return set()
+    return set(row[0] for row in
+               db.session.query(pk).filter(pk.in_(ids)).all())
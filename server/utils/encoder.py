@@ -0,0 +1,114 @@
+#coding: utf-8
+
+"""
+Pluggable JSON encoder backends for API responses.
+
+`JSON_BACKEND` config:
+  auto       : simplejson (C speedups) if installed, else the stdlib (default)
+  simplejson : simplejson
+  ujson      : ujson, falls back to the stdlib for values it can not encode
+  json       : the stdlib
+
+All backends encode `Decimal` as float and `datetime`/`date` as UTC timestamps.
+
+`tagged_default`/`tagged_object_hook` encode them losslessly instead
+({"$dec": "1.10"}, {"$dt": ...}, {"$d": ...}), for values that are read
+back: keyset cursors, query hashes, the messages of `utils.saver`.
+"""
+
+import json
+import logging
+import decimal
+from datetime import datetime, date
+
+from flask import current_app, has_app_context
+
+from utils.common import datetime_to_utcts
+
+
+def default(obj):
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    elif isinstance(obj, date):
+        return datetime_to_utcts(obj)
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+def tagged_default(value):
+    if isinstance(value, decimal.Decimal):
+        # A float would lose precision (the seek comparison on Numeric columns)
+        return {'$dec': str(value)}
+    elif isinstance(value, datetime):
+        return {'$dt': value.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    elif isinstance(value, date):
+        return {'$d': value.strftime('%Y-%m-%d')}
+    raise TypeError(repr(value))
+
+
+def tagged_object_hook(obj):
+    if '$dt' in obj:
+        return datetime.strptime(obj['$dt'], '%Y-%m-%dT%H:%M:%S.%f')
+    elif '$d' in obj:
+        return datetime.strptime(obj['$d'], '%Y-%m-%d').date()
+    elif '$dec' in obj:
+        return decimal.Decimal(obj['$dec'])
+    return obj
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, default=default)
+
+
+def _load_json():
+    return _json_dumps
+
+
+def _load_simplejson():
+    try:
+        import simplejson
+    except ImportError:
+        return None
+    def dumps(obj):
+        return simplejson.dumps(obj, default=default, use_decimal=False)
+    return dumps
+
+
+def _load_ujson():
+    try:
+        import ujson
+    except ImportError:
+        return None
+    def dumps(obj):
+        try:
+            return ujson.dumps(obj, escape_forward_slashes=False, double_precision=15)
+        except (TypeError, ValueError, OverflowError):
+            # Decimal/datetime or other values ujson does not know
+            return _json_dumps(obj)
+    return dumps
+
+
+BACKENDS = {
+    'json'       : _load_json,
+    'simplejson' : _load_simplejson,
+    'ujson'      : _load_ujson,
+}
+
+_dumps_cache = {}
+
+def get_dumps(backend='auto'):
+    """ The `dumps` function of the backend, the stdlib when it is not
+    installed or unknown (checked once per name) """
+    dumps = _dumps_cache.get(backend)
+    if dumps is None:
+        if backend != 'auto' and backend not in BACKENDS:
+            logger = current_app.logger if has_app_context() else logging.getLogger(__name__)
+            logger.warning(u'Unknown JSON_BACKEND: {!r}, using json'.format(backend))
+            names = ['json']
+        else:
+            names = ['simplejson', 'json'] if backend == 'auto' else [backend, 'json']
+        for name in names:
+            dumps = BACKENDS[name]()
+            if dumps is not None:
+                break
+        _dumps_cache[backend] = dumps
+    return dumps
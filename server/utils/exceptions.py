@@ -3,7 +3,8 @@
 from werkzeug.exceptions import (
     BadRequest as BadRequestBase,
     Unauthorized as UnauthorizedBase,
-    Forbidden as ForbiddenBase)
+    Forbidden as ForbiddenBase,
+    ServiceUnavailable as ServiceUnavailableBase)
 from flask import make_response
 
 
@@ -21,6 +22,26 @@ class InvalidQueryOperator(BadRequestBase):
         return u'InvalidQueryOperator(op={})'.format(self.op)
 
 
+class InvalidQueryField(BadRequestBase):
+    def __init__(self, field):
+        self.field = field
+        data = { 'field': field }
+        super(BadRequestBase, self).__init__(self, response=make_response(data))
+
+    def __unicode__(self):
+        return u'InvalidQueryField(field={})'.format(self.field)
+
+
+class InvalidCursor(BadRequestBase):
+    def __init__(self, after):
+        self.after = after
+        data = { 'after': after }
+        super(BadRequestBase, self).__init__(self, response=make_response(data))
+
+    def __unicode__(self):
+        return u'InvalidCursor(after={})'.format(self.after)
+
+
 class PageOverflow(BadRequestBase):
     def __init__(self, query_args, offset, total):
         self.query_args = query_args
@@ -54,3 +75,11 @@ class Forbidden(ForbiddenBase):
     def __init__(self, message=u'无权访问'):
         self.message = message
         super(ForbiddenBase, self).__init__(self, response=make_response(message))
+
+
+class ServiceUnavailable(ServiceUnavailableBase):
+    """ 503 """
+    def __init__(self, message=u'服务繁忙, 请稍后重试', retry_after=1):
+        self.message = message
+        self.retry_after = retry_after
+        super(ServiceUnavailableBase, self).__init__(self, response=make_response(message))
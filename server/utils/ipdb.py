@@ -0,0 +1,140 @@
+#coding: utf-8
+
+"""
+IP geolocation over the 17monip database: the data file is mmapped once per
+process (forked workers share the page cache instead of each holding a copy),
+looked up with a binary search inside the first-octet bucket and fronted by
+an LRU for repeat clients.
+
+    from utils import ipdb
+    ipdb.find('1.2.3.4')                 # u'中国\t北京\t北京' or None
+    ipdb.find_many(['1.2.3.4', ...])     # For log processing
+
+  IPDB_FILE       : The dat file (default: the one shipped with 17monip)
+  IPDB_CACHE_SIZE : Addresses kept in the LRU (default: 10000)
+
+Unlike `IP.find` host names are not resolved, invalid addresses give None.
+"""
+
+import os
+import mmap
+import socket
+import struct
+import threading
+
+import IP
+from flask import current_app, has_app_context
+
+from cache.lru import LRUCache
+
+
+DEFAULT_FILE = os.path.join(os.path.dirname(IP.__file__), '17monipdb.dat')
+
+_unpack_V = struct.Struct('<L').unpack
+_unpack_N = struct.Struct('>L').unpack
+
+
+class IPLocator(object):
+    """ Layout of the dat file:
+
+        | 4 bytes: offset of the data (big endian) |
+        | 256 * 4 bytes: first index entry of each first octet |
+        | 8 bytes per entry: range end ip (4), data position (3), data length (1) |
+        | data |
+    """
+
+    def __init__(self, filename=None, cache_size=10000):
+        self.filename = filename or DEFAULT_FILE
+        with open(self.filename, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offset = _unpack_N(self._buf[:4])[0]
+        self._buckets = [_unpack_V(self._buf[4 + i * 4:8 + i * 4])[0] for i in xrange(256)]
+        self._count = (self._offset - 1028) // 8
+        # The index ends with the range up to 255.255.255.255, what follows
+        # is not sorted (`IP.find` searches it too, e.g. for 225.0.0.1)
+        for i in xrange(self._buckets[255], self._count):
+            if self._buf[1028 + 8 * i:1032 + 8 * i] == '\xff\xff\xff\xff':
+                self._count = i + 1
+                break
+        self.cache = LRUCache(maxsize=cache_size)
+
+    def close(self):
+        self._buf.close()
+
+    def _lookup(self, nip):
+        buf = self._buf
+        first = ord(nip[0])
+        # The covering range ends in this octet or is the first of the next ones
+        lo = self._buckets[first]
+        hi = self._buckets[first + 1] + 1 if first < 255 else self._count
+        hi = min(hi, self._count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = 1028 + 8 * mid
+            # Big endian bytes compare like the numbers
+            if buf[pos:pos + 4] < nip:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo >= self._count:
+            return None
+        pos = 1028 + 8 * lo
+        data_pos = _unpack_V(buf[pos + 4:pos + 7] + '\0')[0]
+        data_len = ord(buf[pos + 7])
+        start = self._offset + data_pos - 1024
+        return buf[start:start + data_len].decode('utf-8').strip()
+
+    def find(self, ip):
+        value = self.cache.get(ip, False)
+        if value is not False:
+            return value
+        try:
+            nip = socket.inet_aton(ip)
+        except (socket.error, TypeError):
+            value = None
+        else:
+            value = self._lookup(nip)
+        self.cache.set(ip, value)
+        return value
+
+    def find_many(self, ips):
+        """ Locations of `ips` in order, each distinct address looked up once
+        (in address order, which keeps the reads of the index local) """
+        found = {}
+        todo = []
+        for ip in set(ips):
+            value = self.cache.get(ip, False)
+            if value is not False:
+                found[ip] = value
+                continue
+            try:
+                todo.append((socket.inet_aton(ip), ip))
+            except (socket.error, TypeError):
+                found[ip] = None
+        for nip, ip in sorted(todo):
+            found[ip] = value = self._lookup(nip)
+            self.cache.set(ip, value)
+        return [found[ip] for ip in ips]
+
+
+_locator = None
+_locator_lock = threading.Lock()
+
+
+def get_locator():
+    global _locator
+    if _locator is None:
+        with _locator_lock:
+            if _locator is None:
+                config = current_app.config if has_app_context() else {}
+                _locator = IPLocator(config.get('IPDB_FILE'),
+                                     config.get('IPDB_CACHE_SIZE', 10000))
+    return _locator
+
+
+def find(ip):
+    return get_locator().find(ip)
+
+
+def find_many(ips):
+    return get_locator().find_many(ips)
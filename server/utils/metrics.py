@@ -0,0 +1,115 @@
+#coding: utf-8
+
+"""
+Per-request performance metrics, sent to statsd in one pipeline per request:
+
+    request.<endpoint>.<method>.latency     total time (ms)
+    request.<endpoint>.<method>.db          time in SQL cursor executions (ms)
+    request.<endpoint>.<method>.queries     number of SQL statements
+    request.<endpoint>.<method>.serialize   time in to_dict/json dumps (ms)
+    request.<endpoint>.<method>.bytes       response body size
+
+`BaseMethodView.metrics` selects which of them a view sends.
+"""
+
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from flask import g, request, current_app, has_request_context
+
+from gvars import statsd_client
+
+
+METRICS = ('latency', 'db', 'queries', 'serialize', 'bytes')
+
+
+_query_hooks = []
+
+def on_query(func):
+    """ Call `func(conn, statement, parameters, executemany, elapsed_ms)`
+    after every statement (one timing for all users, see `utils.profiler`) """
+    _query_hooks.append(func)
+    return func
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = getattr(g, 'query_count', 0) + 1
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    elapsed = time.time() - starts.pop()
+    if has_request_context():
+        g.db_time = getattr(g, 'db_time', 0) + elapsed
+    for hook in _query_hooks:
+        hook(conn, statement, parameters, executemany, elapsed * 1000)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # A failed statement gets no `after_cursor_execute`
+    conn = context.connection
+    if conn is not None and context.execution_context is not None:
+        starts = conn.info.get('query_start')
+        if starts:
+            starts.pop()
+
+
+class timed(object):
+    """ Add the time spent in the block to the request's `g.<name>_time` """
+
+    def __init__(self, name):
+        self.attr = '{}_time'.format(name)
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if has_request_context():
+            setattr(g, self.attr, getattr(g, self.attr, 0) + time.time() - self.start)
+
+
+def query_count():
+    return getattr(g, 'query_count', 0)
+
+
+def check_query_count():
+    """ Warn (log + statsd) when the request ran more than QUERY_COUNT_WARN queries """
+    count = query_count()
+    if count > current_app.config.get('QUERY_COUNT_WARN', 20):
+        current_app.logger.warning(u'Too many queries: endpoint={}, method={}, count={}'.format(
+            request.endpoint, request.method, count))
+        statsd_client.incr('query_count.exceeded.{}.{}'.format(request.endpoint, request.method))
+
+
+def start_request():
+    g.request_start = time.time()
+
+
+def send_request_metrics(response):
+    names = getattr(g, 'metrics', METRICS)
+    start = getattr(g, 'request_start', None)
+    if not names or start is None:
+        return
+    prefix = 'request.{}.{}'.format(request.endpoint, request.method)
+    values = {
+        'latency': (time.time() - start) * 1000,
+        'db': getattr(g, 'db_time', 0) * 1000,
+        'queries': query_count(),
+        'serialize': getattr(g, 'serialize_time', 0) * 1000,
+    }
+    if not response.is_streamed:
+        values['bytes'] = response.calculate_content_length()
+
+    pipe = statsd_client.pipeline()
+    for name in names:
+        if values.get(name) is not None:
+            pipe.timing('{}.{}'.format(prefix, name), values[name])
+    pipe.send()
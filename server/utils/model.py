@@ -1,15 +1,36 @@
 #coding: utf-8
 
+import csv
 import json
+import base64
 import decimal
+import hashlib
+from cStringIO import StringIO
+from operator import attrgetter
 from datetime import datetime, date
 
+import sqlalchemy
+from sqlalchemy import event, bindparam
+from sqlalchemy.orm import joinedload, subqueryload
 from sqlalchemy.types import TypeDecorator
-from flask import current_app
+try:
+    from sqlalchemy.orm import selectinload
+except ImportError:
+    # SQLAlchemy < 1.2
+    selectinload = subqueryload
+try:
+    from sqlalchemy.ext import baked
+except ImportError:
+    # SQLAlchemy < 1.0
+    baked = None
+from flask import current_app, stream_with_context
 
-from utils.exceptions import InvalidQueryOperator, PageOverflow
+from utils.exceptions import (
+    InvalidQueryOperator, InvalidQueryField, InvalidCursor, PageOverflow, BadRequest)
 from utils.common import datetime_to_utcts
-from gvars import db
+from utils.metrics import timed
+from utils.encoder import default as _json_default, tagged_default, tagged_object_hook
+from gvars import db, cache
 
 
 class StrippedString(TypeDecorator):
@@ -21,24 +42,101 @@ class StrippedString(TypeDecorator):
         return value.strip() if value else value
 
 
-class SessionMixin(object):
-    """ Common methods for model classes """
+class ModelSerializer(object):
+    """ `to_dict` of a model class, compiled once from its column types.
 
-    def to_dict(self):
+    Columns whose python type is known from the column type skip the
+    isinstance chain, other columns (custom types) take the generic path.
+    """
+
+    PLAIN, DECIMAL, DATETIME, DATE, ANY = range(5)
+
+    def __init__(self, Model):
+        self.Model = Model
+        self.fields = [(c.name, attrgetter(c.name), '{}_str'.format(c.name),
+                        ModelSerializer.column_kind(c.type))
+                       for c in Model.__table__.columns]
+        self.field_map = dict((field[0], field) for field in self.fields)
+
+    @staticmethod
+    def column_kind(type_):
+        if isinstance(type_, TypeDecorator):
+            # Only decorators that leave the values alone (StrippedString) are
+            # typed by their impl, `Interval` loads a timedelta from a DateTime
+            for name in ('process_result_value', 'result_processor', 'bind_processor'):
+                own = getattr(type(type_), name)
+                if getattr(own, '__func__', own) is not TypeDecorator.__dict__[name]:
+                    return ModelSerializer.ANY
+            type_ = type_.impl
+        if isinstance(type_, db.DateTime):
+            return ModelSerializer.DATETIME
+        elif isinstance(type_, db.Date):
+            return ModelSerializer.DATE
+        elif isinstance(type_, db.Numeric):
+            return ModelSerializer.DECIMAL
+        elif isinstance(type_, (db.Integer, db.String, db.Boolean)):
+            return ModelSerializer.PLAIN
+        return ModelSerializer.ANY
+
+    def select(self, names=None):
+        """ The compiled fields of the given column names (all by default) """
+        if names is None:
+            return self.fields
+        return [self.field_map[name] for name in names]
+
+    def serialize(self, obj, names=None):
+        """ `obj` can be a model object or a row tuple of the selected columns """
+        PLAIN, DECIMAL, DATETIME, DATE = self.PLAIN, self.DECIMAL, self.DATETIME, self.DATE
         data = {}
-        for c in self.__class__.__table__.columns:
-            value = getattr(self, c.name)
-            if isinstance(value, decimal.Decimal):
+        for name, getter, name_str, kind in self.select(names):
+            value = getter(obj)
+            if kind is PLAIN or value is None:
+                pass
+            elif kind is DATETIME:
+                data[name_str] = value.strftime("%Y-%m-%d %H:%M:%S")
+                value = datetime_to_utcts(value)
+            elif kind is DATE:
+                data[name_str] = value.strftime("%Y-%m-%d")
+                value = datetime_to_utcts(value)
+            elif kind is DECIMAL:
+                if isinstance(value, decimal.Decimal):
+                    value = float(value)
+            elif isinstance(value, decimal.Decimal):
                 value = float(value)
             elif isinstance(value, datetime):
-                data['{}_str'.format(c.name)] = value.strftime("%Y-%m-%d %H:%M:%S")
+                data[name_str] = value.strftime("%Y-%m-%d %H:%M:%S")
                 value = datetime_to_utcts(value)
             elif isinstance(value, date):
-                data['{}_str'.format(c.name)] = value.strftime("%Y-%m-%d")
+                data[name_str] = value.strftime("%Y-%m-%d")
                 value = datetime_to_utcts(value)
-            data[c.name] = value
+            data[name] = value
         return data
 
+    def serialize_many(self, objs, names=None):
+        Model = self.Model
+        serialize = self.serialize
+        if names is not None:
+            # Row tuples from a projected query
+            return [serialize(row, names) for row in objs]
+        return [serialize(obj) if type(obj) is Model else obj.to_dict()
+                for obj in objs]
+
+
+_serializers = {}
+
+def get_serializer(Model):
+    serializer = _serializers.get(Model)
+    if serializer is None:
+        serializer = _serializers[Model] = ModelSerializer(Model)
+    return serializer
+
+
+class SessionMixin(object):
+    """ Common methods for model classes """
+
+    def to_dict(self):
+        return get_serializer(type(self)).serialize(self)
+
     def clone(self):
         Model = type(self)
         obj = Model()
@@ -59,6 +157,11 @@ class TheBaseModel(db.Model, SessionMixin):
     __abstract__ = True
 
 
+@event.listens_for(TheBaseModel, 'mapper_configured', propagate=True)
+def _compile_serializer(mapper, Model):
+    _serializers[Model] = ModelSerializer(Model)
+
+
 class BaseModel(TheBaseModel):
     __abstract__ = True
 
@@ -67,6 +170,128 @@ class BaseModel(TheBaseModel):
     updated_at = db.Column(db.DateTime, nullable=True, onupdate=datetime.now)
 
 
+def normalize_filters(filters):
+    """ Canonical JSON of a filter set, the order of filters does not matter """
+    return json.dumps(sorted([list(f) for f in filters]),
+                      sort_keys=True, separators=(',', ':'), default=tagged_default)
+
+
+def encode_cursor(values):
+    """ Encode the sort values of the last row to an opaque `after` token """
+    data = json.dumps(values, default=tagged_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        token = str(token)
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(data, object_hook=tagged_object_hook)
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(token)
+    if not isinstance(values, list):
+        raise InvalidCursor(token)
+    return values
+
+
+class SearchField(object):
+    """ The searchable columns of a model, declared in its Meta:
+
+        class Meta:
+            search_columns = ['title', 'content']
+            search_method = 'fts'       # 'fts' (tsvector, default) or 'trgm' (pg_trgm)
+            search_config = 'simple'    # Text search config of 'fts'
+
+    Filter with `[column, 'search', text]` (or `'*'` for all the columns) and
+    sort by relevance with `['_rank', 'desc']`. `manager.py create_search_indexes`
+    creates the GIN indexes the expressions below can use.
+    """
+
+    def __init__(self, model, columns, method='fts', config='simple'):
+        self.model = model
+        self.columns = columns
+        self.method = method
+        self.config = config
+
+    @staticmethod
+    def of(model, name):
+        Meta = getattr(model, 'Meta', None)
+        columns = list(getattr(Meta, 'search_columns', []))
+        if name != '*':
+            if name not in columns:
+                raise InvalidQueryField(name)
+            columns = [name]
+        if not columns:
+            raise InvalidQueryField(name)
+        return SearchField(model, columns,
+                           getattr(Meta, 'search_method', 'fts'),
+                           getattr(Meta, 'search_config', 'simple'))
+
+    def regconfig(self):
+        return db.literal_column("'{}'::regconfig".format(self.config))
+
+    def document(self):
+        """ to_tsvector(config, coalesce(a, '') || ' ' || coalesce(b, '')) """
+        text = None
+        for name in self.columns:
+            part = db.func.coalesce(getattr(self.model, name), '')
+            text = part if text is None else text + ' ' + part
+        return db.func.to_tsvector(self.regconfig(), text)
+
+    def tsquery(self, value):
+        return db.func.plainto_tsquery(self.regconfig(), value)
+
+    def match(self, value):
+        if self.method == 'trgm':
+            # ILIKE can use a gin_trgm_ops index
+            return db.or_(*[getattr(self.model, name).ilike(u'%{}%'.format(value))
+                            for name in self.columns])
+        return self.document().op('@@')(self.tsquery(value))
+
+    def rank(self, value):
+        if self.method == 'trgm':
+            similarities = [db.func.similarity(getattr(self.model, name), value)
+                            for name in self.columns]
+            if len(similarities) == 1:
+                return similarities[0]
+            return db.func.greatest(*similarities)
+        return db.func.ts_rank(self.document(), self.tsquery(value))
+
+    def index_ddl(self):
+        """ CREATE INDEX statements matching the `match` expressions. They
+        build CONCURRENTLY (no write lock), so run them outside a transaction. """
+        table = self.model.__tablename__
+        if self.method == 'trgm':
+            statements = ['CREATE EXTENSION IF NOT EXISTS pg_trgm']
+            for name in self.columns:
+                statements.append(
+                    'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{0}_{1}_trgm ON "{0}" '
+                    'USING GIN ("{1}" gin_trgm_ops)'.format(table, name))
+            return statements
+        text = " || ' ' || ".join("coalesce(\"{}\", '')".format(name) for name in self.columns)
+        return ['CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{0}_fts ON "{0}" '
+                "USING GIN (to_tsvector('{1}'::regconfig, {2}))".format(table, self.config, text)]
+
+
+# Cached query plans of `QueryProcessor`, keyed by the query shape
+_bakery = baked.bakery(size=500) if baked is not None else None
+
+# Model ==> `_query_key` of `Model.query`
+_model_query_keys = {}
+
+
+def count_rows(Model):
+    """ count(pk): a bare count(*) would lose the FROM without filters """
+    return db.func.count(Model.__mapper__.primary_key[0])
+
+
+def _query_key(query):
+    """ Hash of the SQL and bound values of a query """
+    compiled = query.statement.compile()
+    key = u'{}|{!r}'.format(compiled, sorted(compiled.params.items()))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
 class QueryProcessor():
     FILTER_DICT = {
         # f ==> field;  v ==> value;
@@ -84,81 +309,689 @@ class QueryProcessor():
         '>='        : lambda f, v: f >= v,
         '<'         : lambda f, v: f < v,
         '<='        : lambda f, v: f <= v,
+        # f is a `SearchField` here
+        'search'    : lambda f, v: f.match(v),
+        '~search'   : lambda f, v: ~f.match(v),
+    }
+    SEARCH_OPS = ('search', '~search')
+    # Operators taking a list, and a text pattern
+    LIST_OPS = ('in', '~in')
+    PATTERN_OPS = ('contains', '~contains', 'ilike', '~ilike', 'like', '~like') + SEARCH_OPS
+
+    # Filters whose value can be a bound parameter of a cached query plan:
+    #   op ==> (condition on (field, param), value ==> param value)
+    BIND_FILTER_DICT = {
+        'contains'  : (lambda f, p: f.contains(p), None),
+        '~contains' : (lambda f, p: ~f.contains(p), None),
+        'ilike'     : (lambda f, p: f.ilike(p), lambda v: u'%{}%'.format(v)),
+        '~ilike'    : (lambda f, p: ~f.ilike(p), lambda v: u'%{}%'.format(v)),
+        'like'      : (lambda f, p: f.like(p), lambda v: u'%{}%'.format(v)),
+        '~like'     : (lambda f, p: ~f.like(p), lambda v: u'%{}%'.format(v)),
+        '=='        : (lambda f, p: f == p, None),
+        '!='        : (lambda f, p: f != p, None),
+        '>'         : (lambda f, p: f > p, None),
+        '>='        : (lambda f, p: f >= p, None),
+        '<'         : (lambda f, p: f < p, None),
+        '<='        : (lambda f, p: f <= p, None),
+    }
+    if tuple(int(x) for x in sqlalchemy.__version__.split('.')[:2]) >= (1, 2):
+        # `IN` with one parameter needs an expanding bindparam
+        BIND_FILTER_DICT['in'] = (lambda f, p: f.in_(p), None)
+        BIND_FILTER_DICT['~in'] = (lambda f, p: ~f.in_(p), None)
+
+    AGGREGATE_DICT = {
+        # f ==> field
+        'count' : lambda f: db.func.count(f),
+        'sum'   : lambda f: db.func.sum(f),
+        'avg'   : lambda f: db.func.avg(f),
+        'min'   : lambda f: db.func.min(f),
+        'max'   : lambda f: db.func.max(f),
+    }
+    # Date buckets for `group_by` on DateTime/Date columns: Postgres, SQLite
+    BUCKET_DICT = {
+        'hour'  : ('hour', '%Y-%m-%d %H:00'),
+        'day'   : ('day', '%Y-%m-%d'),
+        'week'  : ('week', '%Y-%W'),
+        'month' : ('month', '%Y-%m'),
+        'year'  : ('year', '%Y'),
+    }
+
+    # How `total` is computed:
+    #   exact    : SELECT count(*) (default)
+    #   estimate : row estimate of the Postgres planner (EXPLAIN), exact count
+    #              when the estimate is small or the database is not Postgres
+    #   cache    : exact count cached in redis per normalized filter set
+    #   none     : no count at all, `has_more` is returned instead of `total`
+    TOTAL_STRATEGIES = ('exact', 'estimate', 'cache', 'none')
+
+    # Streaming export formats ==> mimetype
+    EXPORT_FORMATS = {
+        'ndjson' : 'application/x-ndjson',
+        'csv'    : 'text/csv',
     }
 
     def __init__(self, args, filters=tuple(), sort=tuple(),
-                 page=1, perpage=20, model=None, to_dict_kwargs=None):
+                 page=1, perpage=20, model=None, to_dict_kwargs=None, after=None,
+                 total_strategy='exact', fields=None, export=None, include=None,
+                 aggregate=None):
         self.args = args
         self.filters = filters
         self.sort = sort
         self.page = page
         self.perpage = perpage
+        # Keyset (cursor) pagination: `after` is the token returned as `next`
+        # by the previous page. `None` means the classic page/perpage mode.
+        self.after = after
+        if total_strategy not in QueryProcessor.TOTAL_STRATEGIES:
+            raise ValueError('Invalid total strategy: {}'.format(total_strategy))
+        self.total_strategy = total_strategy
+        # Sparse fieldsets: only select (and serialize) these columns
+        if fields is not None:
+            QueryProcessor.field_columns(model, fields)
+        self.fields = fields
+        # Stream all matched records in this format instead of one page
+        if export is not None and export not in QueryProcessor.EXPORT_FORMATS:
+            raise BadRequest(u'不支持的导出格式: {}'.format(export))
+        self.export = export
+        # Relationships to eager load (for models whose `to_dict` uses them)
+        self.include = include if include else []
+        # Aggregate (group by) query instead of a page of records
+        self.aggregate = aggregate
         self.model = model
         self.query = model.query
         self.to_dict_kwargs = to_dict_kwargs if to_dict_kwargs else {}
 
-    def resolve(self):
-        """
-        Steps:
-        =====
-          1. filter
-          1.1 Check total records.
-          2. sort
-          3. offset
-          4. limit
+    @staticmethod
+    def field_columns(model, fields):
+        """ Column attributes of `fields` (a list of column names), anything
+        else is rejected """
+        if not isinstance(fields, (list, tuple)):
+            raise InvalidQueryField(fields)
+        columns = model.__table__.columns
+        for name in fields:
+            if not isinstance(name, basestring) or name not in columns:
+                raise InvalidQueryField(name)
+        return [getattr(model, name) for name in fields]
+
+    @staticmethod
+    def eager_options(model, include, stream=False):
+        """ Loader options of the relationships in `include`: many-to-one is
+        joined, collections are loaded by a second `IN` query. Collections are
+        skipped for streamed (yield_per) queries which can not eager load them. """
+        relationships = model.__mapper__.relationships
+        options = []
+        for name in include:
+            if name not in relationships:
+                raise InvalidQueryField(name)
+            if not relationships[name].uselist:
+                options.append(joinedload(getattr(model, name)))
+            elif not stream:
+                options.append(selectinload(getattr(model, name)))
+        return options
+
+    @property
+    def is_keyset(self):
+        return self.after is not None
+
+    def keyset_sort(self):
+        """ The sort used by keyset pagination, always ends with `id` so the
+        order is total and the cursor is unique. """
+        sort = [list(item) for item in self.sort]
+        if 'id' not in [name for name, order in sort]:
+            sort.append(['id', sort[-1][1] if sort else 'desc'])
+        return sort
+
+    def is_nullable(self, name):
+        column = self.model.__table__.columns.get(name)
+        return column is not None and column.nullable
+
+    def keyset_order_by(self, sort):
+        """ ORDER BY of keyset mode: NULL sorts as the largest value on every
+        database (`f IS NULL` first), so the cursor condition can seek past it """
+        order_by = []
+        for name, order in sort:
+            field = getattr(self.model, name)
+            if self.is_nullable(name):
+                order_by.append(getattr(field.is_(None), order)())
+            order_by.append(getattr(field, order)())
+        return order_by
+
+    def gen_keyset_cond(self, sort, values):
+        """ Rows strictly after `values` in `sort` order:
+
+            (a > va) OR (a = va AND b > vb) OR (a = va AND b = vb AND id > vid)
+
+        with NULL as the largest value of the nullable columns (see `keyset_order_by`).
         """
         Model = self.model
+        if len(values) != len(sort):
+            raise InvalidCursor(self.after)
+        def equal(field, value):
+            return field.is_(None) if value is None else field == value
+        conds = []
+        for i, (name, order) in enumerate(sort):
+            field = getattr(Model, name)
+            value = values[i]
+            equals = [equal(getattr(Model, n), v) for (n, _), v in zip(sort[:i], values[:i])]
+            if value is None:
+                if order != 'desc':
+                    # Nothing is larger than NULL
+                    continue
+                equals.append(field.isnot(None))
+            elif order == 'desc':
+                equals.append(field < value)
+            elif self.is_nullable(name):
+                equals.append(db.or_(field > value, field.is_(None)))
+            else:
+                equals.append(field > value)
+            conds.append(db.and_(*equals))
+        if not conds:
+            return db.false()
+        return db.or_(*conds)
+
+    @property
+    def offset(self):
+        return 0 if self.is_keyset else self.perpage * (self.page - 1)
+
+    def base_query_key(self):
+        """ Hash of `self.query` (SQL + bound values), so a view that narrows
+        it (tenant, soft delete, ...) does not share keys with the model query """
+        query = self.query
+        if getattr(self, '_base_query', None) is not query:
+            self._base_query = query
+            self._base_query_key = _query_key(query)
+        return self._base_query_key
+
+    def uses_model_query(self):
+        """ Whether `self.query` is the plain `model.query` (no criteria, no
+        custom query class), which the cached plans are built from """
+        Model = self.model
+        if type(self.query) is not db.Query:
+            return False
+        key = _model_query_keys.get(Model)
+        if key is None:
+            key = _model_query_keys[Model] = _query_key(Model.query)
+        return self.base_query_key() == key
+
+    def query_hash(self):
+        """ Canonical hash of the normalized query, independent of filter order """
+        self.check_filters()
+        normalized = json.dumps(
+            [self.base_query_key(),
+             normalize_filters(self.filters), [list(item) for item in self.sort],
+             self.page, self.perpage, self.after, self.fields, self.total_strategy,
+             sorted(self.to_dict_kwargs.items()), sorted(self.include), self.aggregate],
+            sort_keys=True, separators=(',', ':'), default=tagged_default)
+        return hashlib.sha1(normalized).hexdigest()
+
+    def total_cache_key(self):
+        digest = hashlib.sha1(self.base_query_key() + normalize_filters(self.filters)).hexdigest()
+        return 'qp:total:{}:{}'.format(self.model.__tablename__, digest)
+
+    def estimate_count(self, query):
+        """ Row estimate from the Postgres planner, `None` if not available """
+        conn = query.session.connection(mapper=self.model.__mapper__)
+        dialect = conn.dialect
+        if dialect.name != 'postgresql':
+            return None
+        compiled = query.statement.compile(dialect=dialect)
+        plan = conn.execute(u'EXPLAIN (FORMAT JSON) {}'.format(compiled),
+                            compiled.params).scalar()
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def count(self, query):
+        """ Count the filtered query by `self.total_strategy` """
+        config = current_app.config
+        strategy = self.total_strategy
+        if strategy == 'none':
+            return None
+        elif strategy == 'estimate':
+            total = self.estimate_count(query)
+            # Small results are cheap to count and the estimate is too rough
+            if total is not None and \
+               total >= config.get('QUERY_TOTAL_ESTIMATE_THRESHOLD', 1000):
+                return total
+        elif strategy == 'cache':
+            key = self.total_cache_key()
+            total = cache.get(key)
+            if total is None:
+                total = query.count()
+                cache.set(key, total, timeout=config.get('QUERY_TOTAL_CACHE_TTL', 60))
+            return total
+        return query.count()
+
+    def has_records(self):
+        """ Whether the filters match any record (one EXISTS query) """
+        return self.query.session.query(self.filtered().exists()).scalar()
+
+    def fetch(self, query):
+        """ Fetch the page, returns (objects, has_more) """
+        if self.perpage <= 0:
+            return query.all(), False
+        objs = query.limit(self.perpage + 1).all()
+        return objs[:self.perpage], len(objs) > self.perpage
+
+    def serialize(self, objs):
+        Model = self.model
+        if self.fields:
+            return get_serializer(Model).serialize_many(objs, self.fields)
+        if self.uses_default_to_dict():
+            return get_serializer(Model).serialize_many(objs)
+        # 所以 to_dict 方法只允许给出有名字的参数
+        return [obj.to_dict(**self.to_dict_kwargs) for obj in objs]
+
+    def uses_default_to_dict(self):
+        return not self.to_dict_kwargs and \
+            self.model.to_dict.__func__ is SessionMixin.to_dict.__func__
+
+    def export_query(self):
+        """ The query of all matched records, resolved before the response
+        starts so invalid filters/fields/sort are still a 400 """
+        if not self.fields and self.uses_default_to_dict():
+            # Plain row tuples are cheaper than ORM entities
+            self.fields = [field[0] for field in get_serializer(self.model).fields]
+        self.perpage, self.page, self.after = 0, 1, None
+        total, query = self.resolve(with_total=False, stream=True)
+        chunk_size = current_app.config.get('EXPORT_CHUNK_SIZE', 1000)
+        return query.execution_options(stream_results=True).yield_per(chunk_size)
+
+    def iter_export(self, query=None):
+        """ Serialize all matched records chunk by chunk through a server side
+        cursor, so the memory usage does not depend on the result size. """
+        if query is None:
+            query = self.export_query()
+        chunk_size = current_app.config.get('EXPORT_CHUNK_SIZE', 1000)
+        dump_chunk = self.dump_csv_chunk if self.export == 'csv' else self.dump_ndjson_chunk
+        chunk, first = [], True
+        for obj in query:
+            chunk.append(obj)
+            if len(chunk) >= chunk_size:
+                yield dump_chunk(self.serialize(chunk), first)
+                chunk, first = [], False
+        if chunk or first:
+            yield dump_chunk(self.serialize(chunk), first)
+
+    def dump_ndjson_chunk(self, dicts, first):
+        return ''.join(json.dumps(data) + '\n' for data in dicts)
+
+    def dump_csv_chunk(self, dicts, first):
+        names = self.fields or (sorted(dicts[0].keys()) if dicts else [])
+        def encode(value):
+            return value.encode('utf-8') if isinstance(value, unicode) else value
+        buf = StringIO()
+        writer = csv.writer(buf)
+        if first:
+            writer.writerow([encode(name) for name in names])
+        for data in dicts:
+            # Date/time columns are written as their readable `*_str` value
+            writer.writerow([encode(data.get('{}_str'.format(name), data.get(name)))
+                             for name in names])
+        return buf.getvalue()
+
+    def export_response(self):
+        mimetype = QueryProcessor.EXPORT_FORMATS[self.export]
+        query = self.export_query()
+        response = current_app.response_class(
+            stream_with_context(self.iter_export(query)), mimetype=mimetype)
+        response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(
+            self.model.__tablename__, self.export)
+        return response
+
+    def next_cursor(self, obj, sort=None):
+        sort = sort if sort else self.keyset_sort()
+        return encode_cursor([getattr(obj, name) for name, order in sort])
+
+    def filtered(self):
+        """ The query with the filters applied """
+        Model = self.model
         query = self.query
         if query is None:
             raise ValueError('DB Model query not given: {}'.format(str(self)))
 
+        self.check_filters()
         filter_dict = QueryProcessor.FILTER_DICT
         def gen_filter_cond(tModel, name, op, value):
-            if op not in filter_dict:
-                raise InvalidQueryOperator(op)
-            field = getattr(tModel, name)
+            if op in QueryProcessor.SEARCH_OPS:
+                field = SearchField.of(tModel, name)
+            else:
+                field = getattr(tModel, name)
             filter_func = filter_dict[op]
             return filter_func(field, value)
 
-        filters = self.filters
-        orderBy = self.sort
-        offset = self.perpage * (self.page - 1)
+        filter_conds = [gen_filter_cond(Model, name, op, value)
+                        for name, op, value in self.filters]
+        return query.filter(db.and_(*filter_conds))
+
+    def validators(self):
+        """ (etag, last_modified) of the filtered records for conditional GET,
+        from max(updated_at or created_at) and the count in one query.
+        `last_modified` is a naive UTC datetime or None. """
+        Model = self.model
+        modified = db.func.max(db.func.coalesce(Model.updated_at, Model.created_at))
+        modified, count = self.filtered().with_entities(
+            modified, db.func.count()).one()
+        last_modified = None
+        if modified is not None:
+            last_modified = datetime.utcfromtimestamp(datetime_to_utcts(modified))
+        # The full resolution timestamp, an update in the same second changes it
+        etag = hashlib.md5('{}:{}:{}:{}'.format(
+            Model.__tablename__, self.query_hash(), modified, count)).hexdigest()
+        return etag, last_modified
+
+    def check_filters(self):
+        """ `filters` is a list of [field, op, value] with a value that fits
+        `op`, checked the same way for the plain and the cached plan path """
+        attributes = self.model.__mapper__.all_orm_descriptors
+        for item in self.filters:
+            if not isinstance(item, (list, tuple)) or len(item) != 3:
+                raise InvalidQueryField(item)
+            name, op, value = item
+            if op not in QueryProcessor.FILTER_DICT:
+                raise InvalidQueryOperator(op)
+            if not isinstance(name, basestring) or \
+               (op not in QueryProcessor.SEARCH_OPS and name not in attributes):
+                raise InvalidQueryField(name)
+            if op in QueryProcessor.LIST_OPS:
+                valid = isinstance(value, list) and \
+                    not any(isinstance(v, (list, dict)) for v in value)
+            elif op in QueryProcessor.PATTERN_OPS:
+                valid = isinstance(value, (basestring, int, long, float)) and \
+                    not isinstance(value, bool)
+            elif op in ('==', '!='):
+                valid = not isinstance(value, (list, dict))
+            else:
+                valid = value is not None and not isinstance(value, (list, dict))
+            if not valid:
+                raise BadRequest(u'过滤值错误: {} {} {}'.format(
+                    name, op, json.dumps(value)))
+
+    def check_sort(self):
+        """ `sort` is a list of [attribute, 'asc'|'desc'], keyset mode seeks
+        by the cursor values so only columns are allowed there """
+        if not isinstance(self.sort, (list, tuple)):
+            raise InvalidQueryField(self.sort)
+        mapper = self.model.__mapper__
+        attributes = mapper.columns if self.is_keyset else mapper.all_orm_descriptors
+        for item in self.sort:
+            if not isinstance(item, (list, tuple)) or len(item) != 2:
+                raise InvalidQueryField(item)
+            name, order = item
+            if not isinstance(name, basestring) or \
+               (name not in attributes and (name != '_rank' or self.is_keyset)):
+                raise InvalidQueryField(name)
+            if order not in ('asc', 'desc'):
+                raise InvalidQueryOperator(order)
+
+    def sort_field(self, name):
+        """ The column to sort by, `_rank` is the relevance of the search filter """
+        if name != '_rank':
+            return getattr(self.model, name)
+        searches = [(fname, value) for fname, op, value in self.filters if op == 'search']
+        if not searches or self.is_keyset:
+            raise InvalidQueryField(name)
+        fname, value = searches[0]
+        return SearchField.of(self.model, fname).rank(value)
+
+    def resolve(self, with_total=True, stream=False):
+        """
+        Steps:
+        =====
+          1. filter
+          1.1 Check total records.
+          2. sort
+          3. offset (or keyset condition when `after` is given)
+          4. limit
+        """
+        Model = self.model
+        self.check_sort()
+        orderBy = self.keyset_sort() if self.is_keyset else self.sort
+        offset = self.offset
         limit = self.perpage
 
         # 1. Filter
-        filter_conds = [gen_filter_cond(Model, name, op, value)
-                        for name, op, value in filters]
-        query = query.filter(db.and_(*filter_conds))
-        total = query.count()
-        if 0 < total <= offset:
+        query = self.filtered()
+        total = self.count(query) if with_total else None
+        # Only an exact total is reliable here, the others are checked by
+        # `get_rv` after the page was fetched.
+        if with_total and self.total_strategy == 'exact' and 0 < total <= offset:
             raise PageOverflow(str(self), offset, total)
         # 2. Sort
-        orderBy_conds = [getattr(getattr(Model, name), order)()
-                         for name, order in orderBy]
+        if self.is_keyset:
+            orderBy_conds = self.keyset_order_by(orderBy)
+        else:
+            orderBy_conds = [getattr(self.sort_field(name), order)()
+                             for name, order in orderBy]
         query = query.order_by(*orderBy_conds)
-        # 3. Offset
-        query = query.offset(offset)
+        # 3. Offset: keyset mode seeks by the cursor instead of skipping rows
+        if self.is_keyset:
+            if self.after:
+                query = query.filter(
+                    self.gen_keyset_cond(orderBy, decode_cursor(self.after)))
+        else:
+            query = query.offset(offset)
         # 4. Limit: if limit <=0, then get all records
         if limit > 0:
             query = query.limit(limit)
+        # 5. Projection: plain row tuples, no ORM entities
+        if self.fields:
+            names = list(self.fields)
+            if self.is_keyset:
+                names.extend(name for name, order in orderBy if name not in names)
+            query = query.with_entities(*QueryProcessor.field_columns(Model, names))
+        # 6. Eager load the included relationships (no N+1 in `to_dict`)
+        elif self.include:
+            query = query.options(
+                *QueryProcessor.eager_options(Model, self.include, stream=stream))
         return total, query
 
 
+    def gen_bucket(self, name, bucket):
+        if bucket not in QueryProcessor.BUCKET_DICT:
+            raise InvalidQueryOperator(bucket)
+        columns = self.model.__table__.columns
+        if name not in columns or not isinstance(columns[name].type, (db.DateTime, db.Date)):
+            raise InvalidQueryField(name)
+        field = getattr(self.model, name)
+        unit, fmt = QueryProcessor.BUCKET_DICT[bucket]
+        dialect = self.query.session.connection(mapper=self.model.__mapper__).dialect
+        if dialect.name == 'sqlite':
+            return db.func.strftime(fmt, field)
+        return db.func.date_trunc(unit, field)
+
+    def get_aggregate_rv(self):
+        """ Run the `aggregate` section in one GROUP BY statement:
+
+            'aggregate': {
+                'metrics': [['count', '*'], ['sum', 'price'], ...],
+                'group_by': ['status', ['created_at', 'day'], ...]
+            }
+
+        Returns {'columns': [...], 'rows': [[...], ...]}
+        """
+        Model = self.model
+        columns = Model.__table__.columns
+        aggregate = self.aggregate
+        if not isinstance(aggregate, dict):
+            raise InvalidQueryField('aggregate')
+
+        def pair(item, errors):
+            """ [string, string] from the client JSON, `errors` are the
+            exceptions of a bad first/second value """
+            if not isinstance(item, (list, tuple)) or len(item) != 2:
+                raise InvalidQueryField(item)
+            for value, error in zip(item, errors):
+                if not isinstance(value, basestring):
+                    raise error(value)
+            return item
+
+        group_by = aggregate.get('group_by', [])
+        metrics_items = aggregate.get('metrics', [['count', '*']])
+        for items in (group_by, metrics_items):
+            if not isinstance(items, (list, tuple)):
+                raise InvalidQueryField(items)
+
+        names, groups = [], []
+        for item in group_by:
+            if isinstance(item, (list, tuple)):
+                name, bucket = pair(item, (InvalidQueryField, InvalidQueryOperator))
+                groups.append(self.gen_bucket(name, bucket))
+                names.append(u'{}:{}'.format(name, bucket))
+            else:
+                if not isinstance(item, basestring) or item not in columns:
+                    raise InvalidQueryField(item)
+                groups.append(getattr(Model, item))
+                names.append(item)
+
+        metrics = []
+        for item in metrics_items:
+            op, name = pair(item, (InvalidQueryOperator, InvalidQueryField))
+            if op not in QueryProcessor.AGGREGATE_DICT:
+                raise InvalidQueryOperator(op)
+            if name == '*' and op == 'count':
+                metrics.append(count_rows(Model))
+            elif name in columns:
+                metrics.append(QueryProcessor.AGGREGATE_DICT[op](getattr(Model, name)))
+            else:
+                raise InvalidQueryField(name)
+            names.append(u'{}:{}'.format(op, name))
+
+        query = self.filtered().with_entities(*(groups + metrics))
+        if groups:
+            query = query.group_by(*groups).order_by(*groups)
+            query = query.limit(current_app.config.get('AGGREGATE_MAX_GROUPS', 10000))
+        # Decimal/datetime values as float/timestamp, like `to_dict`
+        plain = lambda v: _json_default(v) if isinstance(v, (decimal.Decimal, date)) else v
+        return {'columns': names, 'rows': [[plain(v) for v in row] for row in query.all()]}
+
+    def plan_shape(self):
+        """ The shape of the query (model, filter fields+ops, sort, ...) that
+        keys its cached plan, None when it can not use one. """
+        if _bakery is None or not current_app.config.get('QUERY_PLAN_CACHE', True):
+            return None
+        if self.is_keyset or self.export or self.aggregate or \
+           self.total_strategy == 'estimate':
+            return None
+        self.check_sort()
+        self.check_filters()
+        # A narrowed `processor.query` (tenant, soft delete, ...) is resolved
+        if not self.uses_model_query():
+            return None
+        bind_filter_dict = QueryProcessor.BIND_FILTER_DICT
+        filters = []
+        for name, op, value in self.filters:
+            # `== null` is compiled to IS NULL, a bound NULL matches nothing
+            if op not in bind_filter_dict or value is None:
+                return None
+            filters.append((name, op))
+        return (self.model, tuple(filters), tuple(tuple(item) for item in self.sort),
+                self.perpage > 0, tuple(self.fields or ()), tuple(self.include))
+
+    def run_plan(self, shape):
+        """ `resolve` + `fetch` through the cached plan of `shape`, only the
+        bound values change between requests. Returns (total, objs, has_more) """
+        Model, filters, sort, limited, fields, include = shape
+        bind_filter_dict = QueryProcessor.BIND_FILTER_DICT
+        params = {}
+        for i, (name, op, value) in enumerate(self.filters):
+            convert = bind_filter_dict[op][1]
+            params['qp_f{}'.format(i)] = convert(value) if convert else value
+
+        def filter_query(q):
+            conds = []
+            for i, (name, op) in enumerate(filters):
+                key = 'qp_f{}'.format(i)
+                param = bindparam(key, expanding=True) if op in ('in', '~in') else bindparam(key)
+                conds.append(bind_filter_dict[op][0](getattr(Model, name), param))
+            return q.filter(db.and_(*conds))
+        def page_query(q):
+            q = q.order_by(*[getattr(self.sort_field(name), order)() for name, order in sort])
+            q = q.offset(bindparam('qp_offset'))
+            if limited:
+                q = q.limit(bindparam('qp_limit'))
+            if fields:
+                q = q.with_entities(*QueryProcessor.field_columns(Model, fields))
+            elif include:
+                q = q.options(*QueryProcessor.eager_options(Model, include))
+            return q
+
+        # The shape is part of the cache key, the criteria are built only once
+        base = _bakery(lambda session: session.query(Model), shape)
+        base.add_criteria(filter_query)
+        session = self.query.session
+
+        offset = self.offset
+        total = None
+        if self.total_strategy == 'cache':
+            total = cache.get(self.total_cache_key())
+        if self.total_strategy == 'exact' or \
+           (self.total_strategy == 'cache' and total is None):
+            counter = base.with_criteria(lambda q: q.with_entities(count_rows(Model)))
+            total = counter(session).params(**params).one()[0]
+            if self.total_strategy == 'cache':
+                cache.set(self.total_cache_key(), total,
+                          timeout=current_app.config.get('QUERY_TOTAL_CACHE_TTL', 60))
+            elif 0 < total <= offset:
+                raise PageOverflow(str(self), offset, total)
+
+        params['qp_offset'] = offset
+        params['qp_limit'] = self.perpage + 1
+        objs = base.with_criteria(page_query)(session).params(**params).all()
+        if not limited:
+            return total, objs, False
+        return total, objs[:self.perpage], len(objs) > self.perpage
+
     def get_rv(self, with_objects=True):
-        total, query = self.resolve()
-        rv = {'total': total}
+        if self.aggregate:
+            return self.get_aggregate_rv()
+        shape = self.plan_shape() if with_objects else None
+        if shape is not None:
+            total, objs, has_more = self.run_plan(shape)
+        else:
+            total, query = self.resolve()
+        rv = {'total': total} if total is not None else {}
         if with_objects:
-            # 所以 to_dict 方法只允许给出有名字的参数
-            rv['objects'] = [obj.to_dict(**self.to_dict_kwargs) for obj in query.all()]
+            if shape is None:
+                objs, has_more = self.fetch(query)
+            # As with the exact total, past the end of no records is an empty page
+            if not objs and self.offset > 0 and self.total_strategy != 'exact' and \
+               self.has_records():
+                raise PageOverflow(str(self), self.offset, total)
+            with timed('serialize'):
+                rv['objects'] = self.serialize(objs)
+            if total is None:
+                rv['has_more'] = has_more
+            if self.is_keyset:
+                rv['next'] = self.next_cursor(objs[-1]) if has_more else None
         return rv
 
 
+    @staticmethod
+    def parse_args(request):
+        """ `q` as a dict, BadRequest when it is not a JSON object """
+        try:
+            args = json.loads(request.args.get('q') or '{}')
+        except ValueError:
+            raise BadRequest(u'q 参数错误')
+        if not isinstance(args, dict):
+            raise BadRequest(u'q 参数错误')
+        return args
+
     @staticmethod
     def build(request, model, to_dict_kwargs=None):
         """
         query = {
             'page': Integer,
             'perpage': Integer,
+            'after': String,    # Cursor mode: '' for the first page, then `next`
+            'fields': [String:field, ...],  # Only return these columns
+            'export': String,   # Stream all records: 'ndjson' or 'csv'
+            'include': [String:relationship, ...],  # Eager load for `to_dict`
+            'aggregate': {      # Aggregate instead of records, see `get_aggregate_rv`
+                'metrics': [[String:op, String:field], ...],
+                'group_by': [String:field or [String:field, String:bucket], ...]
+            },
             'filters': [
                 [String:field, String:operation, String:value],
                 ...
@@ -169,19 +1002,30 @@ class QueryProcessor():
             ]
         }
         """
-        args = request.args.get('q', '{}')
-        args = json.loads(args)
+        args = QueryProcessor.parse_args(request)
 
         page    = args.get('page', 1)
         perpage = args.get('perpage', current_app.config['DEFAULT_PERPAGE'])
         filters = args.get('filters', [])
         sort    = args.get('sort', [])
+        after   = args.get('after')
+        fields  = args.get('fields')
+        export  = args.get('export')
+        include = args.get('include', [])
+        aggregate = args.get('aggregate')
 
         Meta = getattr(model, 'Meta', object())
         filters = filters or getattr(Meta, 'default_filters', [])
         sort = sort or getattr(Meta, 'default_sort', []) or [["id", "desc"]]
+        meta_include = list(getattr(Meta, 'include', []))
+        include = meta_include + [name for name in include if name not in meta_include]
         to_dict_kwargs = to_dict_kwargs if to_dict_kwargs else {}
-        return QueryProcessor(args, filters, sort, page, perpage, model, to_dict_kwargs)
+        total_strategy = getattr(Meta, 'total_strategy', None) or \
+                         current_app.config.get('QUERY_TOTAL_STRATEGY', 'exact')
+        return QueryProcessor(args, filters, sort, page, perpage, model,
+                              to_dict_kwargs, after=after, total_strategy=total_strategy,
+                              fields=fields, export=export, include=include,
+                              aggregate=aggregate)
 
     def update_filters(self, callback):
         self.filters = callback(self.filters)
@@ -191,5 +1035,5 @@ class QueryProcessor():
 
     def __str__(self): return unicode(self).encode('utf-8')
     def __unicode__(self):
-        return u'<QueryProcessor(page={}, perpage={}, filters={}, sort={})>'.format(
-            self.page, self.perpage, self.filters, self.sort)
+        return u'<QueryProcessor(page={}, perpage={}, after={}, filters={}, sort={})>'.format(
+            self.page, self.perpage, self.after, self.filters, self.sort)
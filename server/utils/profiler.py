@@ -0,0 +1,162 @@
+#coding: utf-8
+
+"""
+Opt-in profiling:
+
+  PROFILE_SLOW_SQL_MS      : Log statements slower than this with their EXPLAIN (0: off)
+  PROFILE_EXPLAIN_ANALYZE  : Use EXPLAIN ANALYZE (runs the SELECT again!)
+  PROFILE_SAMPLE_RATE      : Fraction of requests to profile (0: off)
+  PROFILE_INTERVAL         : Sampling interval of the profiler in seconds (default: 0.005)
+  PROFILE_DIR              : Where the profiles are written
+
+A profiled request is sampled with a SIGPROF timer (only one request at a
+time per worker) and written as collapsed stacks, the input of
+flamegraph.pl, to `PROFILE_DIR/<endpoint>__<method>__<duration ms>__<time>__<pid>.folded`.
+Under gevent the samples belong to whatever greenlet was running.
+`manager.py profiles` summarizes the files by endpoint.
+"""
+
+import os
+import time
+import random
+import signal
+from collections import defaultdict
+
+from flask import current_app, has_app_context, has_request_context, request
+
+from utils.metrics import on_query
+
+
+# ==============================================================================
+#  Slow SQL
+# ==============================================================================
+
+@on_query
+def _check_slow_sql(conn, statement, parameters, executemany, elapsed):
+    if not has_app_context():
+        return
+    threshold = current_app.config.get('PROFILE_SLOW_SQL_MS', 0)
+    if not threshold or elapsed <= threshold:
+        return
+    log_slow_sql(conn, statement, parameters, executemany, elapsed)
+
+
+def explain(conn, statement, parameters):
+    analyze = current_app.config.get('PROFILE_EXPLAIN_ANALYZE', False)
+    # A separate DBAPI cursor: no events, the original result is untouched
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute('EXPLAIN {}{}'.format('ANALYZE ' if analyze else '', statement),
+                       parameters)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+    finally:
+        cursor.close()
+
+
+def log_slow_sql(conn, statement, parameters, executemany, elapsed):
+    logger = current_app.logger
+    plan = None
+    if conn.dialect.name == 'postgresql' and not executemany and \
+       statement.lstrip().upper().startswith('SELECT'):
+        try:
+            plan = explain(conn, statement, parameters)
+        except Exception:
+            logger.exception(u'EXPLAIN failed: {}'.format(statement))
+    # The `q` of the request tells which filters combination was used
+    where = u'{} {} q={}'.format(request.method, request.endpoint, request.args.get('q')) \
+            if has_request_context() else u'-'
+    logger.warning(u'Slow SQL ({:.1f}ms) [{}]: {}\nparameters={}\n{}'.format(
+        elapsed, where, statement, parameters, plan or ''))
+
+
+# ==============================================================================
+#  Sampled request profiles
+# ==============================================================================
+
+class Sampler(object):
+    """ Statistical profiler counting the stacks seen on each SIGPROF """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+
+    @staticmethod
+    def frame_name(frame):
+        code = frame.f_code
+        return '{}:{}:{}'.format(os.path.basename(code.co_filename),
+                                 code.co_name, code.co_firstlineno)
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            names.append(self.frame_name(frame))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(names))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.iteritems():
+                f.write('{} {}\n'.format(stack, count))
+
+
+_active = None
+
+def start_request():
+    """ Start a sampler for this request if it is picked, returns it (or None) """
+    global _active
+    config = current_app.config
+    rate = config.get('PROFILE_SAMPLE_RATE', 0)
+    if not rate or _active is not None or random.random() >= rate:
+        return None
+    sampler = Sampler(config.get('PROFILE_INTERVAL', 0.005))
+    try:
+        sampler.start()
+    except ValueError:
+        # Signals only work in the main thread
+        return None
+    _active = sampler
+    sampler.started_at = time.time()
+    return sampler
+
+
+def finish_request(sampler):
+    global _active
+    if sampler is None:
+        return
+    sampler.stop()
+    _active = None
+    duration = (time.time() - sampler.started_at) * 1000
+    directory = current_app.config.get('PROFILE_DIR', 'tmp/profiles')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    name = '{}__{}__{}__{}__{}.folded'.format(
+        request.endpoint, request.method, int(duration),
+        int(sampler.started_at * 1000), os.getpid())
+    sampler.dump(os.path.join(directory, name))
+
+
+def load_profiles(directory):
+    """ {(endpoint, method): {'durations': [...], 'stacks': {stack: count}}} """
+    profiles = defaultdict(lambda: {'durations': [], 'stacks': defaultdict(int)})
+    for filename in os.listdir(directory):
+        if not filename.endswith('.folded'):
+            continue
+        parts = filename[:-len('.folded')].split('__')
+        if len(parts) != 5:
+            continue
+        endpoint, method, duration = parts[0], parts[1], int(parts[2])
+        profile = profiles[(endpoint, method)]
+        profile['durations'].append(duration)
+        with open(os.path.join(directory, filename)) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                profile['stacks'][stack] += int(count)
+    return profiles
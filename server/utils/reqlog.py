@@ -0,0 +1,183 @@
+#coding: utf-8
+
+"""
+Structured request log that never blocks a request: `MyFlask` puts one
+compact record per request in a bounded queue, a background writer (see
+`utils.background`) formats them as JSON lines and writes them in batches
+to a rotating file and/or a UDP sink. Records that don't fit in the queue
+are dropped and counted (statsd `reqlog.dropped`).
+
+    {"ts": 1476776400.123, "endpoint": "api.items", "method": "GET",
+     "status": 200, "ms": 12.3, "ip": "1.2.3.4", "bytes": 5120}
+
+  REQUEST_LOG           : Enable (default: False)
+  REQUEST_LOG_FILE      : Log file, rotated by size (default: None)
+  REQUEST_LOG_MAX_BYTES : Rotate at this size (default: 100MB)
+  REQUEST_LOG_BACKUPS   : Rotated files kept (default: 5)
+  REQUEST_LOG_UDP       : 'host:port' to send the lines to (default: None)
+  REQUEST_LOG_QUEUE     : Records waiting to be written (default: 10000)
+  REQUEST_LOG_BATCH     : Records written per batch (default: 500)
+  REQUEST_LOG_SAMPLE    : {endpoint: rate} logged share of high volume
+                          endpoints (default: {}, all). Errors (>= 400)
+                          are always logged.
+"""
+
+import os
+import json
+import time
+import socket
+import random
+import threading
+from collections import OrderedDict
+
+from flask import request, g
+
+from gvars import statsd_client
+from utils.background import BackgroundWriter, run_blocking
+
+
+class FileSink(object):
+    """ Append to `path`, rotate to path.1 ... path.<backups> by size """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.open()
+
+    def open(self):
+        self.stream = open(self.path, 'a')
+        self.size = self.stream.tell()
+
+    def rotate(self):
+        self.stream.close()
+        for i in xrange(self.backups - 1, 0, -1):
+            src = '{}.{}'.format(self.path, i)
+            if os.path.exists(src):
+                os.rename(src, '{}.{}'.format(self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def write(self, lines):
+        # Disk I/O would block the gevent hub
+        run_blocking(self.write_lines, lines)
+
+    def write_lines(self, lines):
+        data = '\n'.join(lines) + '\n'
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.stream.write(data)
+        self.stream.flush()
+        self.size += len(data)
+
+
+class UDPSink(object):
+    """ Lines packed into datagrams of at most `max_size` bytes """
+
+    def __init__(self, address, max_size=1400):
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.max_size = max_size
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def write(self, lines):
+        packet, size = [], 0
+        for line in lines:
+            if packet and size + len(line) + 1 > self.max_size:
+                self.send(packet)
+                packet, size = [], 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self.send(packet)
+
+    def send(self, packet):
+        try:
+            self.sock.sendto('\n'.join(packet), self.address)
+        except socket.error:
+            statsd_client.incr('reqlog.udp_error')
+
+
+class RequestLog(BackgroundWriter):
+
+    name = 'request-log'
+    dropped_metric = 'reqlog.dropped'
+
+    def __init__(self, sinks, maxsize=10000, batch_size=500, logger=None):
+        self.sinks = sinks
+        BackgroundWriter.__init__(self, maxsize=maxsize, batch_size=batch_size, logger=logger)
+
+    def write(self, records):
+        lines = [format_record(record) for record in records]
+        for sink in self.sinks:
+            try:
+                sink.write(lines)
+            except Exception:
+                if self.logger:
+                    self.logger.exception(u'Request log write failed: {}'.format(sink))
+
+
+FIELDS = ('ts', 'endpoint', 'method', 'status', 'ms', 'ip', 'bytes')
+
+
+def format_record(record):
+    return json.dumps(OrderedDict(zip(FIELDS, record)), separators=(',', ':'))
+
+
+def client_ip():
+    """ X-Real-IP (set by our nginx), else the address the nearest proxy
+    appended to X-Forwarded-For; the leftmost one is whatever the client sent """
+    real_ip = request.headers.get('X-Real-IP')
+    if real_ip:
+        return real_ip.strip()
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded:
+        return forwarded.rsplit(',', 1)[-1].strip()
+    return request.remote_addr
+
+
+_request_log = None
+_request_log_lock = threading.Lock()
+
+
+def get_request_log(app):
+    """ One writer per process, like `utils.saver.get_publisher` """
+    global _request_log
+    if _request_log is None or _request_log.pid != os.getpid():
+        with _request_log_lock:
+            if _request_log is None or _request_log.pid != os.getpid():
+                config = app.config
+                sinks = []
+                if config.get('REQUEST_LOG_FILE'):
+                    sinks.append(FileSink(config['REQUEST_LOG_FILE'],
+                                          config.get('REQUEST_LOG_MAX_BYTES', 100 * 1024 * 1024),
+                                          config.get('REQUEST_LOG_BACKUPS', 5)))
+                if config.get('REQUEST_LOG_UDP'):
+                    sinks.append(UDPSink(config['REQUEST_LOG_UDP']))
+                _request_log = RequestLog(sinks, maxsize=config.get('REQUEST_LOG_QUEUE', 10000),
+                                          batch_size=config.get('REQUEST_LOG_BATCH', 500),
+                                          logger=app.logger)
+    return _request_log
+
+
+def log_request(app, response):
+    """ Queue the record of the current request (cheap, never blocks) """
+    config = app.config
+    if not config.get('REQUEST_LOG', False):
+        return
+    status = response.status_code
+    endpoint = request.endpoint
+    rate = config.get('REQUEST_LOG_SAMPLE', {}).get(endpoint, 1)
+    if status < 400 and rate < 1 and random.random() >= rate:
+        return
+    now = time.time()
+    start = getattr(g, 'request_start', now)
+    size = None if response.is_streamed else response.calculate_content_length()
+    get_request_log(app).put((now, endpoint, request.method, status,
+                              round((now - start) * 1000, 2), client_ip(), size))
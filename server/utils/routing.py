@@ -0,0 +1,142 @@
+#coding: utf-8
+
+"""
+Read-replica routing for Flask-SQLAlchemy.
+
+Use it for `gvars.db`:
+
+    db = RoutingSQLAlchemy()
+
+and declare the replicas as binds:
+
+    SQLALCHEMY_BINDS = {
+        'replica1': 'postgresql://xxx@replica1/xxx',
+        'replica2': 'postgresql://xxx@replica2/xxx',   # or 'sqlite:////tmp/replica.db' locally
+    }
+    SQLALCHEMY_REPLICAS = ['replica1', 'replica2']
+    SQLALCHEMY_REPLICA_MAX_LAG = 5        # Skip replicas lagging more (seconds)
+    SQLALCHEMY_REPLICA_LAG_CHECK = 5      # Measure the lag at most every N seconds
+    SQLALCHEMY_STICKY_SECONDS = 5         # Stay on the primary after a client writes
+
+Read-only requests (GET/HEAD on `BaseMethodView` subclasses with
+`read_replica = True`) are sent to a healthy replica, picked once per session.
+Everything else, and every flush, goes to the primary. A client that wrote
+gets a cookie which keeps its reads on the primary for SQLALCHEMY_STICKY_SECONDS.
+Reads whose result is shared with other clients (cache fills) are done in a
+`primary_reads()` block, so a lagging replica can not put stale rows there.
+"""
+
+import time
+import random
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from flask import g, request, current_app, has_request_context, after_this_request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+
+
+STICKY_COOKIE = 'db_primary'
+
+
+def is_read_only():
+    """ Whether the current request may read from a replica """
+    return has_request_context() and \
+        getattr(g, 'db_read_only', False) and \
+        STICKY_COOKIE not in request.cookies
+
+
+@contextmanager
+def primary_reads():
+    """ Read from the primary inside the block """
+    if not has_request_context():
+        yield
+        return
+    read_only = getattr(g, 'db_read_only', False)
+    g.db_read_only = False
+    try:
+        yield
+    finally:
+        g.db_read_only = read_only
+
+
+def mark_written():
+    """ Keep the reads of this client on the primary for a while """
+    if not has_request_context() or getattr(g, 'db_written', False) or \
+       not current_app.config.get('SQLALCHEMY_REPLICAS'):
+        return
+    g.db_written = True
+    seconds = current_app.config.get('SQLALCHEMY_STICKY_SECONDS', 5)
+
+    @after_this_request
+    def set_sticky(response):
+        response.set_cookie(STICKY_COOKIE, '1', max_age=seconds)
+        return response
+
+
+class RoutingSession(SignallingSession):
+
+    def __init__(self, db, *args, **kwargs):
+        self.db = db
+        self._replica = None
+        SignallingSession.__init__(self, db, *args, **kwargs)
+
+    def get_bind(self, mapper=None, clause=None):
+        if mapper is not None:
+            info = getattr(mapper.mapped_table, 'info', {})
+            if info.get('bind_key'):
+                return SignallingSession.get_bind(self, mapper, clause)
+        if not self._flushing and is_read_only():
+            if self._replica is None:
+                self._replica = self.db.choose_replica(self.app) or False
+            if self._replica:
+                return self._replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    if session.new or session.dirty or session.deleted:
+        mark_written()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def __init__(self, *args, **kwargs):
+        SQLAlchemy.__init__(self, *args, **kwargs)
+        # bind ==> (lag in seconds, measured at)
+        self._replica_lags = {}
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def measure_lag(self, engine):
+        if engine.dialect.name != 'postgresql':
+            return 0
+        # The replay timestamp alone keeps growing while the primary is idle:
+        # a replica that replayed all it received is not lagging
+        sql = ('SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+               'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END')
+        with engine.connect() as conn:
+            return float(conn.execute(sql).scalar())
+
+    def replica_lag(self, app, bind):
+        lag, checked_at = self._replica_lags.get(bind, (None, 0))
+        now = time.time()
+        if now - checked_at > app.config.get('SQLALCHEMY_REPLICA_LAG_CHECK', 5):
+            try:
+                lag = self.measure_lag(self.get_engine(app, bind))
+            except Exception:
+                app.logger.exception(u'Measure replica lag failed: {}'.format(bind))
+                lag = float('inf')
+            self._replica_lags[bind] = (lag, now)
+        return lag
+
+    def choose_replica(self, app):
+        """ The engine of a random replica within the lag limit, None if there is none """
+        config = app.config
+        max_lag = config.get('SQLALCHEMY_REPLICA_MAX_LAG', 5)
+        healthy = [bind for bind in config.get('SQLALCHEMY_REPLICAS', [])
+                   if self.replica_lag(app, bind) <= max_lag]
+        if not healthy:
+            return None
+        return self.get_engine(app, random.choice(healthy))
@@ -0,0 +1,149 @@
+#coding: utf-8
+
+"""
+Write-behind inserts: request handlers hand rows to `save` and return, a
+background publisher sends them to the MQ in batches and `workers/saver.py`
+inserts them with multi-row INSERT/COPY.
+
+    from utils import saver
+    saver.save(models.Tracking, {'user_id': 1, 'action': u'open'})
+
+  SAVER_MQ_URL        : Transport url, e.g. 'memory://' (default: amqp from MQ_*)
+  SAVER_QUEUE         : Queue (and routing key) name (default: 'saver')
+  SAVER_BUFFER        : Rows buffered in the worker process (default: 10000),
+                        rows beyond are dropped (statsd `saver.dropped`),
+                        see `utils.background`
+  SAVER_PUBLISH_BATCH : Rows per message (default: 200)
+  EXCHANGE_NAME, EXCHANGE_TYPE : The exchange (default: 'amq.direct', 'direct'),
+                        the queue name on transports other than RabbitMQ
+
+Message bodies are JSON: {"rows": [[table, {column: value}], ...]},
+datetimes keep their type (see `encode_rows`).
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+from datetime import datetime
+
+from kombu import Connection, Exchange, Queue as MQueue
+from flask import current_app
+
+from gvars import statsd_client
+from utils.encoder import tagged_default, tagged_object_hook
+from utils.background import BackgroundWriter
+
+
+def mq_url(config):
+    url = config.get('SAVER_MQ_URL')
+    if url:
+        return url
+    return 'amqp://{}:{}@{}:{}//'.format(
+        config.get('MQ_USER', 'guest'), config.get('MQ_PASSWD', 'guest'),
+        config.get('MQ_HOST', '127.0.0.1'), config.get('MQ_PORT', 5672))
+
+
+def mq_queue(config):
+    name = config.get('SAVER_QUEUE', 'saver')
+    exchange = config.get('EXCHANGE_NAME', 'amq.direct')
+    if exchange.startswith('amq.') and \
+       not mq_url(config).startswith(('amqp', 'pyamqp', 'librabbitmq')):
+        # Only RabbitMQ predefines the amq.* exchanges
+        exchange = name
+    exchange = Exchange(exchange, type=config.get('EXCHANGE_TYPE', 'direct'))
+    return MQueue(name, exchange=exchange, routing_key=name)
+
+
+def encode_rows(rows):
+    return json.dumps({'rows': rows}, default=tagged_default, separators=(',', ':'))
+
+
+def decode_rows(body):
+    return json.loads(body, object_hook=tagged_object_hook)['rows']
+
+
+class Publisher(BackgroundWriter):
+    """ Rows buffered in the process and sent in batches, so `put` never
+    waits on the broker """
+
+    name = 'saver-publisher'
+    dropped_metric = 'saver.dropped'
+
+    def __init__(self, url, mq_queue, maxsize=10000, batch_size=200, logger=None):
+        self.url = url
+        self.mq_queue = mq_queue
+        self.conn = self.producer = None
+        BackgroundWriter.__init__(self, maxsize=maxsize, batch_size=batch_size, logger=logger)
+
+    def put(self, table, values):
+        return BackgroundWriter.put(self, (table, values))
+
+    def write(self, rows):
+        try:
+            if self.producer is None:
+                self.conn = Connection(self.url)
+                self.producer = self.conn.Producer()
+            self.producer.publish(
+                encode_rows(rows), content_type='application/json',
+                content_encoding='utf-8', exchange=self.mq_queue.exchange,
+                routing_key=self.mq_queue.routing_key, declare=[self.mq_queue],
+                retry=True, retry_policy={'max_retries': 3})
+            statsd_client.incr('saver.published', len(rows))
+        except Exception:
+            statsd_client.incr('saver.lost', len(rows))
+            self.close()
+            # Reconnect on the next batch, not in a tight loop
+            time.sleep(1)
+            raise
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.release()
+            except Exception:
+                pass
+        self.conn = self.producer = None
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    """ One publisher per process, started after the gunicorn fork """
+    global _publisher
+    if _publisher is None or _publisher.pid != os.getpid():
+        with _publisher_lock:
+            if _publisher is None or _publisher.pid != os.getpid():
+                config = current_app.config
+                _publisher = Publisher(
+                    mq_url(config), mq_queue(config),
+                    maxsize=config.get('SAVER_BUFFER', 10000),
+                    batch_size=config.get('SAVER_PUBLISH_BATCH', 200),
+                    logger=current_app.logger)
+    return _publisher
+
+
+def save(Model, values):
+    """ Queue a row (dict) or rows (list of dicts) of `Model` for insertion.
+    Never blocks; returns False when (some) rows were dropped. """
+    if isinstance(values, dict):
+        values = [values]
+    publisher = get_publisher()
+    # Keep the time of the request rather than the time of the insert
+    stamp = 'created_at' in Model.__table__.c
+    now = datetime.now()
+    ok = True
+    for row in values:
+        if stamp and 'created_at' not in row:
+            row = dict(row, created_at=now)
+        ok = publisher.put(Model.__tablename__, row) and ok
+    return ok
+
+
+@atexit.register
+def _flush_at_exit():
+    if _publisher is not None and _publisher.pid == os.getpid():
+        _publisher.flush(timeout=2)
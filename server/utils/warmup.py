@@ -0,0 +1,115 @@
+#coding: utf-8
+
+"""
+Gunicorn preload and warm-up, wired by `etc/gunicorn/apiapp.py` when
+`preload_app` is on:
+
+  master (before fork) : `preload` configures the mappers (and the compiled
+                         serializers), mmaps the IP database and drops any DB
+                         connection so the workers don't inherit it
+  worker (after init)  : `warm_worker` opens DB connections and the redis pool,
+                         optionally runs `self_check`
+
+statsd timings (ms):
+    startup.preload                 config load -> app ready in the master
+    startup.worker                  fork -> worker warm
+    startup.self_check.<endpoint>   first GET of an endpoint in the self-check
+    startup.first_request           the first real request of a worker
+
+  WARMUP_DB_CONNECTIONS : Connections opened per worker (default: 1)
+  WARMUP_SELF_CHECK     : GET every list url once per worker (default: False)
+"""
+
+import time
+import json
+
+import redis
+from sqlalchemy.orm import configure_mappers
+from flask import request, g
+
+from gvars import db, statsd_client
+from cache import get_redis
+
+
+# Requests of the self-check are marked in the WSGI environ
+SELF_CHECK_ENVIRON = 'warmup.self_check'
+
+_first_request_pending = True
+
+
+def _engines(app):
+    binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or {})
+    return [db.get_engine(app, bind) for bind in binds]
+
+
+def preload(app, started=None):
+    """ Run in the master once the app is imported """
+    with app.app_context():
+        configure_mappers()
+        from utils import ipdb
+        ipdb.get_locator()
+    for engine in _engines(app):
+        engine.dispose()
+    if started is not None:
+        statsd_client.timing('startup.preload', int((time.time() - started) * 1000))
+    app.logger.info(u'Preloaded: rules={}'.format(len(list(app.url_map.iter_rules()))))
+
+
+def warm_worker(app, forked=None, self_check=None):
+    """ Run in the worker before it accepts requests """
+    config = app.config
+    with app.app_context():
+        for engine in _engines(app):
+            conns = [engine.connect() for _ in xrange(config.get('WARMUP_DB_CONNECTIONS', 1))]
+            for conn in conns:
+                conn.close()
+        try:
+            get_redis().ping()
+        except redis.RedisError:
+            app.logger.exception(u'Warm up redis failed')
+    if self_check is None:
+        self_check = config.get('WARMUP_SELF_CHECK', False)
+    if self_check:
+        run_self_check(app)
+    if forked is not None:
+        statsd_client.timing('startup.worker', int((time.time() - forked) * 1000))
+
+
+def self_check_urls(app):
+    """ GET urls without required arguments (the list urls of the views) """
+    for rule in app.url_map.iter_rules():
+        if 'GET' not in rule.methods or rule.endpoint == 'static':
+            continue
+        if rule.arguments - set(rule.defaults or {}):
+            continue
+        yield rule.endpoint, rule.rule
+
+
+def run_self_check(app):
+    client = app.test_client()
+    query = {'q': json.dumps({'perpage': 1})}
+    for endpoint, url in self_check_urls(app):
+        start = time.time()
+        try:
+            response = client.get(url, query_string=query,
+                                  environ_base={SELF_CHECK_ENVIRON: True})
+            status = response.status_code
+            response.close()
+        except Exception:
+            app.logger.exception(u'Self-check failed: url={}'.format(url))
+            continue
+        statsd_client.timing('startup.self_check.{}'.format(endpoint),
+                             int((time.time() - start) * 1000))
+        if status >= 500:
+            app.logger.error(u'Self-check failed: url={}, status={}'.format(url, status))
+
+
+def first_request_done():
+    """ Called by `MyFlask` after each request until a real one was served """
+    global _first_request_pending
+    if not _first_request_pending or request.environ.get(SELF_CHECK_ENVIRON):
+        return
+    _first_request_pending = False
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        statsd_client.timing('startup.first_request', int((time.time() - start) * 1000))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#coding: utf-8
+
+"""
+Saver worker: consume the rows queued by `utils.saver.save` and insert them
+in batches, grouped by model, with multi-row INSERT (COPY for large batches
+on Postgres, see `utils.bulk.insert`).
+
+    python -u workers/saver.py -b tmp/log [--url memory://] [-s 1000] [-i 1]
+
+A batch is flushed when it has `--batch-size` rows or `--interval` seconds
+passed. Rows that fail to insert are written to the backup directory (`-b`)
+as JSON lines (only logged without it), the messages are acked either way.
+SIGINT/SIGTERM stop consuming, flush what was received and exit.
+"""
+
+import os
+import sys
+import time
+import errno
+import socket
+import signal
+import argparse
+from datetime import date
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kombu import Connection
+
+from gvars import db, statsd_client
+from utils import bulk
+from utils.common import get_stdout_logger
+from utils.model import TheBaseModel
+from utils.saver import mq_url, mq_queue, encode_rows, decode_rows
+from cache import api_cache
+
+
+logger = get_stdout_logger('{xxx}-saver')
+
+
+def model_tables():
+    """ {table name: Model} of the mapped `TheBaseModel` subclasses """
+    tables = {}
+    stack = TheBaseModel.__subclasses__()
+    while stack:
+        Model = stack.pop()
+        stack.extend(Model.__subclasses__())
+        if hasattr(Model, '__table__'):
+            tables[Model.__table__.name] = Model
+    return tables
+
+
+class Saver(object):
+
+    def __init__(self, conn, queue, tables, batch_size=1000, interval=1.0,
+                 prefetch=100, backup_dir=None):
+        self.conn = conn
+        self.queue = queue
+        self.tables = tables
+        self.batch_size = batch_size
+        self.interval = interval
+        self.prefetch = prefetch
+        self.backup_dir = backup_dir
+        self.messages = []
+        self.rows = []
+        self.flushed_at = time.time()
+        self.stopping = False
+
+    def stop(self, signum=None, frame=None):
+        logger.info('Stopping (signal={})'.format(signum))
+        self.stopping = True
+
+    def on_message(self, body, message):
+        try:
+            rows = decode_rows(message.body)
+        except (ValueError, KeyError, TypeError):
+            logger.exception(u'Bad message: {!r}'.format(message.body[:200]))
+            message.ack()
+            return
+        self.messages.append(message)
+        self.rows.extend(rows)
+
+    def run(self):
+        with self.conn.Consumer([self.queue], callbacks=[self.on_message]) as consumer:
+            consumer.qos(prefetch_count=self.prefetch)
+            while not self.stopping:
+                # Wake up at least every second to see a stop request (a
+                # signal does not interrupt every transport's wait)
+                timeout = min(max(self.flushed_at + self.interval - time.time(), 0.01), 1)
+                try:
+                    self.conn.drain_events(timeout=timeout)
+                except socket.timeout:
+                    pass
+                except (IOError, OSError) as e:
+                    # A signal interrupted the wait
+                    if e.errno != errno.EINTR:
+                        raise
+                if len(self.rows) >= self.batch_size or \
+                   time.time() - self.flushed_at >= self.interval:
+                    self.flush()
+        self.flush()
+
+    def flush(self):
+        self.flushed_at = time.time()
+        if not self.messages:
+            return
+        messages, rows = self.messages, self.rows
+        self.messages, self.rows = [], []
+
+        groups = OrderedDict()
+        for table, values in rows:
+            groups.setdefault(table, []).append(values)
+        failed = []
+        for table, items in groups.iteritems():
+            failed.extend([table, item] for item in self.insert(table, items))
+
+        if failed:
+            self.backup(failed)
+        for message in messages:
+            message.ack()
+        statsd_client.incr('saver.saved', len(rows) - len(failed))
+        statsd_client.timing('saver.flush', int((time.time() - self.flushed_at) * 1000))
+        logger.info('Flushed: rows={}, failed={}, tables={}'.format(
+            len(rows), len(failed), len(groups)))
+
+    def insert(self, table, items):
+        """ Insert the rows of a table, returns the rows that failed """
+        Model = self.tables.get(table)
+        if Model is None:
+            logger.error(u'Unknown table: {}'.format(table))
+            return items
+        # `created_at` is set by `utils.saver.save`
+        valid, errors = bulk.validate_items(Model, items, readonly=('updated_at',))
+        for i, error in errors.iteritems():
+            logger.error(u'Invalid row: table={}, error={}, row={!r}'.format(
+                table, error, items[i]))
+        try:
+            ids, db_errors = bulk.insert(Model, [values for i, values in valid])
+            db.session.commit()
+            # As in `BaseMethodView.bulk_done`
+            if len(db_errors) < len(valid) and api_cache.is_list_cacheable(Model):
+                api_cache.bump_versions([Model])
+        except Exception:
+            db.session.rollback()
+            logger.exception(u'Insert failed: table={}, rows={}'.format(table, len(valid)))
+            return items
+        for n, error in db_errors.iteritems():
+            i = valid[n][0]
+            errors[i] = error
+            logger.error(u'Rejected row: table={}, error={}, row={!r}'.format(
+                table, error, items[i]))
+        return [items[i] for i in sorted(errors)]
+
+    def backup(self, rows):
+        statsd_client.incr('saver.failed', len(rows))
+        if not self.backup_dir:
+            logger.error(u'Rows lost: {}'.format(encode_rows(rows)))
+            return
+        if not os.path.isdir(self.backup_dir):
+            os.makedirs(self.backup_dir)
+        path = os.path.join(self.backup_dir, 'saver-failed-{}.log'.format(
+            date.today().strftime('%Y%m%d')))
+        with open(path, 'a') as f:
+            f.write(encode_rows(rows) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u'Batch insert the queued rows')
+    parser.add_argument('-b', '--backup-dir', help=u'Directory for the rows that failed')
+    parser.add_argument('--url', help=u'Transport url (default: from the app config)')
+    parser.add_argument('-s', '--batch-size', type=int, default=1000)
+    parser.add_argument('-i', '--interval', type=float, default=1.0)
+    args = parser.parse_args()
+
+    from webapp import app
+    import models
+
+    with app.app_context():
+        config = app.config
+        with Connection(args.url or mq_url(config)) as conn:
+            saver = Saver(conn, mq_queue(config), model_tables(),
+                          batch_size=args.batch_size, interval=args.interval,
+                          prefetch=config.get('SAVER_PREFETCH', 100),
+                          backup_dir=args.backup_dir)
+            signal.signal(signal.SIGINT, saver.stop)
+            signal.signal(signal.SIGTERM, saver.stop)
+            logger.info('Saver started: queue={}, tables={}'.format(
+                saver.queue.name, len(saver.tables)))
+            saver.run()
+    logger.info('Saver stopped')
+
+
+if __name__ == '__main__':
+    main()